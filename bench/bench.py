@@ -0,0 +1,280 @@
+#!/usr/bin/python
+"""Benchmark of the ingest and query paths of EDMS.
+
+A server is started on a temporary database, a synthetic fleet of devices sends its reports to it and the pages are
+then queried. The results are written as JSON so that two versions can be compared:
+
+    python bench/bench.py --devices 200 --reports 20000 --output before.json
+"""
+import argparse
+import cookielib
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+import zlib
+import Queue
+
+EDMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "edms.py")
+
+parser = argparse.ArgumentParser(description="EDMS benchmark")
+parser.add_argument("--devices", type=int, default=100, help="Number of devices")
+parser.add_argument("--properties", type=int, default=20, help="Number of properties per report")
+parser.add_argument("--depth", type=int, default=1, help="Nesting depth of the properties (for json_flatten)")
+parser.add_argument("--changes", type=float, default=0.2, help="Ratio of properties changing between two reports")
+parser.add_argument("--duplicates", type=float, default=0.05, help="Ratio of reports sent twice")
+parser.add_argument("--types", type=int, default=3, help="Number of report types")
+parser.add_argument("--reports", type=int, default=5000, help="Number of reports to send")
+parser.add_argument("--bulk", type=int, default=0, help="Send the reports to /reports/bulk by batches of this size")
+parser.add_argument("--gzip", action="store_true", help="Send the reports gzipped")
+parser.add_argument("--concurrency", type=int, default=8, help="Number of concurrent senders")
+parser.add_argument("--queries", type=int, default=50, help="Number of times each query is run")
+parser.add_argument("--seed", type=int, default=1, help="Seed of the generated fleet")
+parser.add_argument("--port", type=int, default=18888, help="Port of the server")
+parser.add_argument("--server-args", default="", help="Arguments of the server (--server-args=\"--ingest-queue\")")
+parser.add_argument("--keep", action="store_true", help="Keep the database")
+parser.add_argument("--output", help="JSON output file (standard output by default)")
+args = parser.parse_args()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def stats(latencies, duration=None):
+    """Latencies are in seconds, the stats in milliseconds."""
+    result = {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+    }
+    if duration:
+        result["duration_s"] = round(duration, 3)
+        result["per_second"] = round(len(latencies) / duration, 1)
+    return result
+
+
+def json_flatten(data):
+    """Same as json_flatten in edms.py, the properties are stored and searched by these names."""
+    if not isinstance(data, dict):
+        return data
+    sub = {}
+    for name, value in data.iteritems():
+        if isinstance(value, dict):
+            for vn, vv in value.iteritems():
+                sub[name + "." + vn] = json_flatten(vv)
+        else:
+            sub[name] = value
+    return sub
+
+
+class Fleet(object):
+    """Devices sending reports whose properties slowly change."""
+    def __init__(self, rnd):
+        self.rnd = rnd
+        self.date = datetime.datetime(2014, 1, 1)
+        self.devices = []
+        for i in range(args.devices):
+            self.devices.append({
+                "hostname": "bench-{i:05d}".format(i=i),
+                "device_group": "group-{g}".format(g=i % 10),
+                "properties": [self.value(j) for j in range(args.properties)],
+            })
+
+    def value(self, j):
+        if j % 2:
+            return self.rnd.randint(0, 1000)
+        return "value-{v}".format(v=self.rnd.randint(0, 20))
+
+    def nest(self, j, value):
+        """Property j, under args.depth levels."""
+        for level in range(args.depth - 1, 0, -1):
+            value = {"l{level}".format(level=level): value}
+        return "p{j}".format(j=j), value
+
+    def reports(self):
+        sent = []
+        for i in range(args.reports):
+            if sent and self.rnd.random() < args.duplicates:
+                yield self.rnd.choice(sent)
+                continue
+            device = self.rnd.choice(self.devices)
+            for j in range(args.properties):
+                if self.rnd.random() < args.changes:
+                    device["properties"][j] = self.value(j)
+            self.date += datetime.timedelta(seconds=1)
+            report = {
+                "hostname": device["hostname"],
+                "device_group": device["device_group"],
+                "type": "type-{t}".format(t=i % args.types),
+                "date": self.date.strftime('%Y-%m-%d %H:%M:%S.%f'),
+            }
+            report.update(self.nest(j, v) for j, v in enumerate(device["properties"]))
+            body = json.dumps(report)
+            sent.append(body)
+            yield body
+
+
+class Server(object):
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix="edms-bench-")
+        self.db = os.path.join(self.directory, "main.db")
+        self.url = "http://localhost:{port}".format(port=args.port)
+        self.log = open(os.path.join(self.directory, "server.log"), "w")
+        self.process = subprocess.Popen(
+            [sys.executable, EDMS, "--port", str(args.port), "--db", self.db] + args.server_args.split(),
+            stdout=self.log, stderr=subprocess.STDOUT
+        )
+        for i in range(100):
+            try:
+                urllib2.urlopen(self.url + "/about").read()
+                break
+            except IOError:
+                if self.process.poll() is not None:
+                    raise Exception("Server stopped, see " + self.log.name)
+                time.sleep(0.1)
+        else:
+            raise Exception("Server didn't start, see " + self.log.name)
+
+        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+        self.opener.open(self.url + "/login", urllib.urlencode({"username": "admin", "password": "admin"})).read()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        self.log.close()
+        if args.keep:
+            print >> sys.stderr, "Database kept in " + self.db
+        else:
+            shutil.rmtree(self.directory)
+
+    def db_size(self):
+        return sum(os.path.getsize(self.db + suffix) for suffix in ("", "-wal") if os.path.exists(self.db + suffix))
+
+
+def ingest(server, fleet):
+    bodies = Queue.Queue()
+    if args.bulk:
+        batch = []
+        for body in fleet.reports():
+            batch.append(body)
+            if len(batch) == args.bulk:
+                bodies.put(("/reports/bulk", "\n".join(batch)))
+                batch = []
+        if batch:
+            bodies.put(("/reports/bulk", "\n".join(batch)))
+    else:
+        for body in fleet.reports():
+            bodies.put(("/report", body))
+
+    latencies = []
+    statuses = {}
+    sent_bytes = [0]
+    lock = threading.Lock()
+
+    def send():
+        while True:
+            try:
+                path, body = bodies.get_nowait()
+            except Queue.Empty:
+                return
+            headers = {}
+            if args.gzip:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                body = compressor.compress(body) + compressor.flush()
+                headers["Content-Encoding"] = "gzip"
+            start = time.time()
+            try:
+                status = urllib2.urlopen(urllib2.Request(server.url + path, body, headers)).getcode()
+            except urllib2.HTTPError as e:
+                status = e.code
+            with lock:
+                sent_bytes[0] += len(body)
+                latencies.append(time.time() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=send) for i in range(args.concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = stats(latencies, time.time() - start)
+    result["statuses"] = statuses
+    result["sent_bytes"] = sent_bytes[0]
+    if args.bulk:
+        result["reports_per_second"] = round(args.reports / result["duration_s"], 1)
+    return result
+
+
+def queries(server, fleet):
+    device = fleet.devices[0]
+    # The first property as the server stores it, with --depth it's nested
+    property_name, value = json_flatten(dict([fleet.nest(0, device["properties"][0])])).items()[0]
+    value = json.dumps(value)
+    pages = [
+        ("last_reports", "/last-reports"),
+        ("last_reports_type", "/last-reports?type=type-0"),
+        ("last_reports_property", "/last-reports?" + urllib.urlencode({property_name: value})),
+        ("last_reports_type_property", "/last-reports?" + urllib.urlencode({"type": "type-1", property_name: value})),
+        ("device_by_id", "/device/1"),
+        ("device_by_ident", "/device/hostname:" + device["hostname"]),
+        ("devices", "/devices"),
+        ("devices_date_seen", "/devices?sort=date_seen"),
+        ("devices_search", "/devices?" + urllib.urlencode({"q": "bench-0001"})),
+        ("api_devices_search", "/api/devices/search?" + urllib.urlencode({property_name: value})),
+    ]
+    results = {}
+    for name, path in pages:
+        latencies = []
+        for i in range(args.queries):
+            start = time.time()
+            server.opener.open(server.url + path).read()
+            latencies.append(time.time() - start)
+        results[name] = stats(latencies)
+    return results
+
+
+def git_version():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(EDMS), stderr=open(os.devnull, "w")
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    server = Server()
+    try:
+        fleet = Fleet(random.Random(args.seed))
+        result = {
+            "version": git_version(),
+            "date": datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+            "parameters": vars(args),
+            "ingest": ingest(server, fleet),
+            "queries": queries(server, fleet),
+            "db_size_bytes": server.db_size(),
+        }
+    finally:
+        server.stop()
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    json.dump(result, output, indent=2, sort_keys=True)
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
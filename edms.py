@@ -1,37 +1,347 @@
-from datetime import datetime
-from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError, OperationalError
+import tornado.concurrent
 import tornado.escape
+import tornado.gen
 import tornado.ioloop
 import tornado.web
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
 import os
 import re
 import gettext
 import sqlalchemy
 import hashlib
+import hmac
 import base64
 import uuid
 import argparse
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index
+import urllib
+import threading
+import time
+import Queue
+import bisect
+import collections
+import gzip
+import multiprocessing
+import sys
+import csv
+import StringIO
+import zlib
+import json
+import math
+import signal
+import abc
+import itertools
+import heapq
+import random
+from sqlalchemy import Column, Integer, String, DateTime, Float, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, backref
+from sqlalchemy.schema import CreateTable, CreateIndex, CreateColumn
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship, backref, aliased
+from tornado.log import app_log, access_log
 _ = gettext.gettext
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 # Deb packages:
 # *
 # * python-sqlalchemy
 # * python-tornado
+# * python-msgpack (optional, for MessagePack reports)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='EDMS')
+    parser.add_argument('command', nargs='?', choices=['serve', 'import'], default='serve',
+                        help='Run the server (default) or import NDJSON report files')
+    parser.add_argument('files', nargs='*', metavar='FILE', help='NDJSON files to import, they can be gzipped')
     parser.add_argument('--port', metavar='PORT', type=int, help='Server port', default=8888)
     parser.add_argument('--sql', action='store_true', help='Show SQL requests')
+    parser.add_argument('--processes', metavar='NB', type=int, default=1,
+                        help='Number of server processes sharing the port (0 for one per CPU)')
+    parser.add_argument('--config-refresh', metavar='MS', type=int, default=1000,
+                        help='Period of the configuration changes check when running many processes')
     parser.add_argument('--db', metavar="DB_FILE", help='Database file to use', default='main.db')
+    parser.add_argument('--db-journal-mode', metavar='MODE', default='WAL',
+                        choices=['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'],
+                        help='SQLite journal mode, WAL allows to read while writing')
+    parser.add_argument('--db-synchronous', metavar='LEVEL', default='NORMAL',
+                        choices=['OFF', 'NORMAL', 'FULL', 'EXTRA'],
+                        help='SQLite synchronous level, NORMAL is safe in WAL mode')
+    parser.add_argument('--db-busy-timeout', metavar='MS', type=int, default=5000,
+                        help='Time to wait for a locked database')
+    parser.add_argument('--db-pool-size', metavar='NB', type=int, default=5, help='Database connections pool size')
+    parser.add_argument('--max-streams', metavar='NB', type=int, default=8,
+                        help='Number of exports and properties series streamed at once, the others are answered 503')
+    parser.add_argument('--compaction-period', metavar='S', type=int, default=60,
+                        help='Period of the history rollup and retention job, 0 to disable it')
+    parser.add_argument('--compaction-budget', metavar='MS', type=int, default=200,
+                        help='Maximum time spent by the history rollup and retention job at each run')
+    parser.add_argument('--import-batch-size', metavar='NB', type=int, default=5000,
+                        help='Number of reports imported per transaction')
+    parser.add_argument('--import-workers', metavar='NB', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of processes parsing the imported reports')
+    parser.add_argument('--import-checkpoint', metavar='FILE',
+                        help='File saving the import progress, to resume it (default: DB_FILE.import)')
+    parser.add_argument('--import-defer-indexes', action='store_true',
+                        help='Drop the search indexes during the import and build them afterwards')
+    parser.add_argument('--ingest-queue', action='store_true',
+                        help='Acknowledge reports at once and store them by batches from a writer thread')
+    parser.add_argument('--ingest-batch-size', metavar='NB', type=int, default=500,
+                        help='Maximum number of reports committed at once by the writer thread')
+    parser.add_argument('--ingest-linger', metavar='MS', type=int, default=50,
+                        help='Time the writer thread waits for more reports before committing a batch')
+    parser.add_argument('--property-cache-size', metavar='NB', type=int, default=10000,
+                        help='Number of devices whose current properties are kept in memory')
+    parser.add_argument('--ingest-high-water', metavar='NB', type=int, default=10000,
+                        help='Number of queued reports above which new reports are refused (503)')
+    parser.add_argument('--group-stats-period', metavar='S', type=int, default=60,
+                        help='Period of the count of the devices seen in the last 24 hours by group, 0 to disable it')
+    parser.add_argument('--event-batch-size', metavar='NB', type=int, default=2000,
+                        help='Maximum number of events committed at once by the events writer thread')
+    parser.add_argument('--event-high-water', metavar='NB', type=int, default=100000,
+                        help='Number of queued events above which new events are refused (503)')
+    parser.add_argument('--config-poll-timeout', metavar='S', type=int, default=60,
+                        help='Longest time a device waits for its configuration on /device-config')
+    parser.add_argument('--auth-cache-ttl', metavar='S', type=int, default=60,
+                        help='Time users are kept in memory, other processes see their changes after it')
+    parser.add_argument('--device-cache-size', metavar='NB', type=int, default=100000,
+                        help='Number of device ids kept in memory by ident')
+    parser.add_argument('--render-cache-size', metavar='MB', type=int, default=32,
+                        help='Size of the rendered device, devices and report pages kept in memory, 0 to disable it')
+    parser.add_argument('--profile-sample', metavar='RATIO', type=float, default=0,
+                        help='Ratio of the requests whose SQL statements are profiled')
+    parser.add_argument('--profile-slow', metavar='MS', type=int, default=500,
+                        help='Profiled requests slower than that are logged with their statements')
+    parser.add_argument('--profile-repeat', metavar='NB', type=int, default=10,
+                        help='Number of executions of the same statement in a request reported as N+1 queries')
     args = parser.parse_args()
 
-engine = sqlalchemy.create_engine('sqlite:///'+args.db, echo=args.sql)
+engine = sqlalchemy.create_engine(
+    'sqlite:///'+args.db,
+    echo=args.sql,
+    poolclass=sqlalchemy.pool.QueuePool,
+    pool_size=args.db_pool_size,
+    connect_args={'check_same_thread': False, 'timeout': args.db_busy_timeout / 1000.0}
+)
+
+
+@sqlalchemy.event.listens_for(engine, "connect")
+def db_connect(dbapi_connection, connection_record):
+    # We issue the BEGIN statements ourselves (see db_begin)
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode={mode}".format(mode=args.db_journal_mode))
+    cursor.execute("PRAGMA synchronous={level}".format(level=args.db_synchronous))
+    cursor.execute("PRAGMA busy_timeout={timeout}".format(timeout=args.db_busy_timeout))
+    cursor.close()
+
+
+@sqlalchemy.event.listens_for(engine, "begin")
+def db_begin(conn):
+    # Writers can ask for an IMMEDIATE transaction to take the write lock before reading anything
+    conn.execute("BEGIN " + conn.get_execution_options().get("sqlite_begin", "DEFERRED"))
+
+
+def begin_write(db):
+    """Starts a transaction holding the database write lock.
+
+    What is read within it can't be changed by an other thread or process before it is committed.
+    """
+    db.commit()
+    db.connection(execution_options={"sqlite_begin": "IMMEDIATE"})
 
 Session = sessionmaker(bind=engine)
-session = Session()
+# Each thread gets its own session, request handlers release it when they finish
+session = scoped_session(Session)
+
+
+class Metrics(object):
+    """Counters and histograms exposed on /metrics.
+
+    Each thread updates its own values without any lock, they are summed when they are scraped.
+    """
+    BUCKETS = {
+        "edms_request_duration_seconds": (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+        "edms_request_sql_queries": (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+        "edms_request_sql_seconds": (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5),
+        "edms_report_properties": (1, 2, 5, 10, 20, 50, 100, 200, 500),
+    }
+
+    def __init__(self):
+        self.local = threading.local()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def values(self):
+        try:
+            return self.local.values
+        except AttributeError:
+            values = self.local.values = {}
+            with self.lock:
+                self.threads.append(values)
+            return values
+
+    def inc(self, name, value=1, **labels):
+        values = self.values()
+        key = (name, tuple(sorted(labels.items())))
+        values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        values = self.values()
+        key = (name, tuple(sorted(labels.items())))
+        histogram = values.get(key)
+        if histogram is None:
+            # One counter per bucket, one for the values above the last bucket, and the sum
+            histogram = values[key] = [0] * (len(self.BUCKETS[name]) + 1) + [0]
+        histogram[bisect.bisect_left(self.BUCKETS[name], value)] += 1
+        histogram[-1] += value
+
+    def sql_start(self):
+        """SQL queries are counted for the current request of the thread."""
+        self.local.sql = [0, 0.0]
+
+    def sql_done(self, **labels):
+        sql = getattr(self.local, "sql", None)
+        if sql:
+            self.observe("edms_request_sql_queries", sql[0], **labels)
+            self.observe("edms_request_sql_seconds", sql[1], **labels)
+            self.local.sql = None
+
+    def sql_query(self, duration):
+        self.inc("edms_sql_queries_total")
+        self.inc("edms_sql_seconds_total", duration)
+        sql = getattr(self.local, "sql", None)
+        if sql:
+            sql[0] += 1
+            sql[1] += duration
+
+    def render(self, gauges):
+        """Prometheus text format."""
+        with self.lock:
+            threads = [dict(values) for values in self.threads]
+        counters = {}
+        histograms = {}
+        for values in threads:
+            for key, value in values.iteritems():
+                if isinstance(value, list):
+                    histogram = histograms.setdefault(key, [0] * len(value))
+                    for i, v in enumerate(value):
+                        histogram[i] += v
+                else:
+                    counters[key] = counters.get(key, 0) + value
+        for key, value in gauges.iteritems():
+            counters[(key, ())] = value
+
+        def labels(pairs):
+            if not pairs:
+                return ""
+            return "{" + ",".join('{k}="{v}"'.format(k=k, v=str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for k, v in pairs) + "}"
+
+        lines = []
+        typed = set()
+        for (name, pairs), value in sorted(counters.iteritems()):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {name} {type}".format(
+                    name=name, type="gauge" if name in gauges else "counter"))
+            lines.append("{name}{labels} {value}".format(name=name, labels=labels(pairs), value=value))
+        for (name, pairs), histogram in sorted(histograms.iteritems()):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {name} histogram".format(name=name))
+            total = 0
+            for le, count in zip(self.BUCKETS[name] + ("+Inf",), histogram):
+                total += count
+                lines.append("{name}_bucket{labels} {value}".format(
+                    name=name, labels=labels(pairs + (("le", le),)), value=total))
+            lines.append("{name}_sum{labels} {value}".format(name=name, labels=labels(pairs), value=histogram[-1]))
+            lines.append("{name}_count{labels} {value}".format(name=name, labels=labels(pairs), value=total))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+
+class Profiler(object):
+    """SQL statements of a sample of the requests.
+
+    Slow requests are logged with their statements, the slowest ones are kept for the profile page. Statements are
+    attributed to the request of the thread, those of coroutines interleaved on the IO loop can get mixed.
+    """
+    def __init__(self, sample, slow, repeat, size=50):
+        self.sample = sample
+        self.slow = slow / 1000.0
+        self.repeat = repeat
+        self.size = size
+        self.local = threading.local()
+        self.slowest = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.local.statements = [] if self.sample and random.random() < self.sample else None
+
+    def query(self, statement, duration):
+        statements = getattr(self.local, "statements", None)
+        if statements is not None:
+            statements.append((statement, duration))
+
+    def done(self, handler):
+        statements = getattr(self.local, "statements", None)
+        if statements is None:
+            return
+        self.local.statements = None
+
+        duration = handler.request.request_time()
+        counts = collections.Counter(statement for statement, d in statements)
+        profile = {
+            "date": datetime.utcnow(),
+            "duration": duration,
+            "request": handler._request_summary(),
+            "status": handler.get_status(),
+            "statements": statements,
+            "sql_duration": sum(d for s, d in statements),
+            "repeated": [(statement, nb) for statement, nb in counts.most_common() if nb >= self.repeat],
+        }
+
+        if duration >= self.slow:
+            app_log.warning(
+                "Slow request: %s %.2fms, %d statements (%.2fms)%s",
+                profile["request"], 1000 * duration, len(statements), 1000 * profile["sql_duration"],
+                "".join("\n  %.2fms %s" % (1000 * d, s) for s, d in statements)
+            )
+        for statement, nb in profile["repeated"]:
+            app_log.warning("N+1 queries: %s executed %d times by %s", statement, nb, profile["request"])
+
+        with self.lock:
+            entry = (duration, id(profile), profile)
+            if len(self.slowest) < self.size:
+                heapq.heappush(self.slowest, entry)
+            elif duration > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def profiles(self):
+        with self.lock:
+            return [profile for d, i, profile in sorted(self.slowest, reverse=True)]
+
+profiler = Profiler(args.profile_sample, args.profile_slow, args.profile_repeat)
+
+
+@sqlalchemy.event.listens_for(engine, "before_cursor_execute")
+def db_before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.time())
+
+
+@sqlalchemy.event.listens_for(engine, "after_cursor_execute")
+def db_after_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.time() - conn.info["query_start"].pop()
+    metrics.sql_query(duration)
+    profiler.query(statement, duration)
+
 
 Base = declarative_base()
 
@@ -68,12 +378,19 @@ class Device(Base):
     date_updated = Column(DateTime)
     date_seen = Column(DateTime)
     group_id = Column(Integer, ForeignKey('device_group.id'))
+    # Incremented when its reports change its history, the pages showing it are then rendered again
+    version = Column(Integer)
 
     group = relationship("DeviceGroup", order_by=DeviceGroup.id)
 
     def __repr__(self):
         return "Device<ident={ident},type={type}>".format(id=self.id, name=self.name)
 
+# Devices lookup by ident, search by ident prefix and pagination by last seen date
+Index("device_ident_unique", Device.ident, unique=True)
+Index("device_date_seen_id", Device.date_seen, Device.id)
+Index("device_group_id", Device.group_id, Device.id)
+
 
 class DeviceReport(Base):
     """Device log"""
@@ -96,6 +413,9 @@ class DeviceReport(Base):
             content=self.content
         )
 
+# Report log of a device, most recent first
+Index("device_report_device_id_date_id", DeviceReport.device_id, DeviceReport.date, DeviceReport.id)
+
 Index(
     "device_log_device_id_date_type",
     DeviceReport.device_id,
@@ -128,6 +448,10 @@ class DeviceConfig(Base):
 
     device = relationship("Device", order_by=Device.id)
 
+Index("device_config_device_name", DeviceConfig.device_id, DeviceConfig.name, unique=True)
+# Other processes look for the values set since they last checked
+Index("device_config_date_set", DeviceConfig.date_set)
+
 
 class DeviceProperty(Base):
     """Last property for all devices."""
@@ -139,10 +463,16 @@ class DeviceProperty(Base):
 # We want to be able to search a device by one of its property
 # like "ether_macaddress" = "010203040506"
 Index("device_properties_name_value", DeviceProperty.name, DeviceProperty.value)
+# Devices having a property value, sorted by id (see PostingList)
+Index("device_properties_name_value_device", DeviceProperty.name, DeviceProperty.value, DeviceProperty.device_id)
 
 
 class DevicePropertyHistory(Base):
-    """Properties history for all devices."""
+    """Properties history for all devices.
+
+    It's now written to one table per month (see history_partitions), this one has the history written before and the
+    last values of the dropped months.
+    """
     __tablename__ = "device_property_history"
     id = Column(Integer, primary_key=True)
     device_id = Column(Integer, ForeignKey('device.id'))
@@ -154,6 +484,13 @@ class DevicePropertyHistory(Base):
     device = relationship("Device", order_by=Device.id)
     report = relationship("DeviceReport", order_by=DeviceReport.id)
 
+# Reports having a property value, sorted by id (see PostingList)
+Index(
+    "device_property_history_name_value_report",
+    DevicePropertyHistory.name,
+    DevicePropertyHistory.value,
+    DevicePropertyHistory.report_id)
+
 Index(
     "device_property_history_id_name_date",
     DevicePropertyHistory.device_id,
@@ -161,51 +498,473 @@ Index(
     DevicePropertyHistory.date,
     unique=True)
 
+# Rollups and retention work by date ranges
+Index("device_property_history_date", DevicePropertyHistory.date)
+
+
+class DevicePropertyRollup(Base):
+    """Hourly and daily aggregates of the properties history, they remain once the history is deleted."""
+    __tablename__ = "device_property_rollup"
+    device_id = Column(Integer, primary_key=True)
+    name = Column(String, primary_key=True)
+    period = Column(Integer, primary_key=True)  # In seconds
+    date = Column(DateTime, primary_key=True)  # Beginning of the period
+    count = Column(Integer)
+    number_count = Column(Integer)  # Numeric values, they are the ones in min, max and sum
+    min = Column(Float)
+    max = Column(Float)
+    sum = Column(Float)
+    last_date = Column(DateTime)
+    last_value = Column(String)
+
+Index("device_property_rollup_period_date", DevicePropertyRollup.period, DevicePropertyRollup.date)
+
+
+class DevicePropertyRollupPending(Base):
+    """Hours whose history was written since they were rolled up."""
+    __tablename__ = "device_property_rollup_pending"
+    date = Column(DateTime, primary_key=True)
+
+
+class DeviceGroupTree(Base):
+    """Closure of the groups hierarchy: every group is linked to itself and to all its descendants."""
+    __tablename__ = "device_group_tree"
+    ancestor_id = Column(Integer, primary_key=True)
+    descendant_id = Column(Integer, primary_key=True)
+    distance = Column(Integer)
+
+Index("device_group_tree_descendant", DeviceGroupTree.descendant_id)
+
+
+class DeviceGroupStats(Base):
+    """Devices of a group (not including its subgroups), updated when reports are stored."""
+    __tablename__ = "device_group_stats"
+    group_id = Column(Integer, primary_key=True)
+    device_count = Column(Integer)
+    seen_24h = Column(Integer)
+    last_report_date = Column(DateTime)
+
 
-Base.metadata.create_all(engine)
+class DeviceEventType(Base):
+    """Names of the events types, events only store their id."""
+    __tablename__ = "device_event_type"
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True)
+
+
+# Indexes dropped once the index replacing them is created
+REPLACED_INDEXES = {
+    "device_ident_unique": ("device_ident",),
+}
+
+
+def db_create():
+    """Creates the missing tables and the columns and indexes that were added to existing tables."""
+    Base.metadata.create_all(engine)
+    inspector = sqlalchemy.inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                print("Adding column {table}.{name}...".format(table=table.name, name=column.name))
+                engine.execute("ALTER TABLE {table} ADD COLUMN {column}".format(
+                    table=table.name, column=CreateColumn(column).compile(dialect=engine.dialect)))
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                print("Creating index {name}...".format(name=index.name))
+                try:
+                    index.create(engine)
+                except IntegrityError:
+                    # Older versions could create two devices with the same ident
+                    print("WARNING: {name} can't be created, {table} has duplicates".format(
+                        name=index.name, table=table.name))
+                    continue
+                for name in REPLACED_INDEXES.get(index.name, ()):
+                    engine.execute("DROP INDEX IF EXISTS {name}".format(name=name))
+
+db_create()
+
+
+class MonthPartitions(object):
+    """Rows split in one table per month, named <name>_YYYYMM.
+
+    Queries only read the tables of the months they cover and old months are dropped as a whole, whatever their number
+    of rows. Tables are created when the first row of their month is written.
+    """
+    def __init__(self, name, columns, indexes, unique=(), deferrable=()):
+        """columns returns new Column objects, indexes are (suffix, column names) tuples.
+
+        unique and deferrable are suffixes of indexes, the deferrable ones aren't created while an import defers them.
+        """
+        self.name = name
+        self.columns = columns
+        self.indexes = indexes
+        self.unique = unique
+        self.deferrable = deferrable
+        self.deferred = False
+        self.metadata = sqlalchemy.MetaData()
+        self.pattern = re.compile("^" + name + r"_([0-9]{6})$")
+        # Tables we know exist, to write without checking
+        self.created = set()
+        # The tables are defined from the request handlers and from the writer and compaction threads
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def month(date):
+        return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    def table(self, month):
+        name = "{name}_{month:%Y%m}".format(name=self.name, month=month)
+        with self.lock:
+            table = self.metadata.tables.get(name)
+            if table is None:
+                table = sqlalchemy.Table(name, self.metadata, *self.columns())
+                for suffix, columns in self.indexes:
+                    sqlalchemy.Index(
+                        name + "_" + suffix, *[table.c[column] for column in columns], unique=suffix in self.unique
+                    )
+        return table
+
+    def create_indexes(self, db, table):
+        for index in table.indexes:
+            if self.deferred and index.name[len(table.name) + 1:] in self.deferrable:
+                continue
+            db.execute(str(CreateIndex(index).compile(dialect=engine.dialect))
+                       .replace("INDEX ", "INDEX IF NOT EXISTS ", 1))
+
+    def writable(self, db, date):
+        """Table of the month of a date, created if needed. The transaction has to be IMMEDIATE."""
+        table = self.table(self.month(date))
+        if table.name not in self.created:
+            # Other processes may create the same table at the same time
+            db.execute(str(CreateTable(table).compile(dialect=engine.dialect))
+                       .replace("CREATE TABLE ", "CREATE TABLE IF NOT EXISTS ", 1))
+            self.create_indexes(db, table)
+            self.created.add(table.name)
+        return table
+
+    def insert(self, db, date, rows, prefix=None):
+        """Inserts rows in the table of the month of a date. The transaction has to be IMMEDIATE."""
+        table = self.writable(db, date)
+        statement = table.insert().prefix_with(prefix) if prefix else table.insert()
+        try:
+            db.execute(statement, rows)
+        except OperationalError:
+            # The compaction of another process may have dropped the table since we created it
+            self.created.discard(table.name)
+            self.writable(db, date)
+            db.execute(statement, rows)
+
+    def defer_indexes(self, db):
+        """Drops the deferrable indexes, the tables created until undefer_indexes don't have them."""
+        self.deferred = True
+        for month in self.months(db):
+            for suffix in self.deferrable:
+                db.execute("DROP INDEX IF EXISTS {name}_{suffix}".format(name=self.table(month).name, suffix=suffix))
+
+    def undefer_indexes(self, db):
+        self.deferred = False
+        for month in self.months(db):
+            self.create_indexes(db, self.table(month))
+
+    def rollback(self):
+        """The tables created by a transaction that was rolled back don't exist."""
+        self.created.clear()
+
+    def months(self, db):
+        """Months that have a table, from the most recent."""
+        months = []
+        for name, in db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE :prefix",
+                                {"prefix": self.name + "_%"}):
+            match = self.pattern.match(name)
+            if match:
+                months.append(datetime.strptime(match.group(1), "%Y%m"))
+        return sorted(months, reverse=True)
+
+    def covering(self, db, date_from=None, date_to=None):
+        """Tables that may have rows in [date_from, date_to), from the most recent."""
+        return [
+            self.table(month) for month in self.months(db)
+            if (date_from is None or month >= self.month(date_from)) and (date_to is None or month < date_to)
+        ]
+
+    def before(self, db, date):
+        """Months whose whole month is before a date, from the oldest."""
+        return sorted(month for month in self.months(db) if month < self.month(date))
+
+    def drop(self, db, month):
+        table = self.table(month)
+        db.execute("DROP TABLE IF EXISTS {name}".format(name=table.name))
+        self.created.discard(table.name)
+
+    def drop_before(self, db, date):
+        """Drops the tables whose whole month is before a date, returns their number."""
+        months = self.before(db, date)
+        for month in months:
+            self.drop(db, month)
+        return len(months)
+
+
+def event_columns():
+    return [
+        Column("id", Integer, primary_key=True),
+        Column("device_id", Integer),
+        Column("type_id", Integer),
+        Column("date", DateTime),
+        # The other fields of the event, as JSON
+        Column("data", String),
+    ]
+
+event_partitions = MonthPartitions(
+    "device_event", event_columns, [("device_date", ("device_id", "date")), ("type_date", ("type_id", "date"))]
+)
+
+
+def history_columns():
+    return [
+        Column("id", Integer, primary_key=True),
+        Column("device_id", Integer),
+        Column("report_id", Integer),
+        Column("date", DateTime),
+        Column("name", String),
+        Column("value", String),
+    ]
+
+# The same indexes as the device_property_history table, which keeps the history written before it was partitioned
+# and the last values of the dropped months
+history_partitions = MonthPartitions(
+    "device_property_history",
+    history_columns,
+    [
+        ("id_name_date", ("device_id", "name", "date")),
+        ("name_value_report", ("name", "value", "report_id")),
+        ("report_id", ("report_id",)),
+        ("date", ("date",)),
+    ],
+    unique=("id_name_date",),
+    deferrable=("name_value_report", "date")
+)
+
+
+def history_tables(db, date_from=None, date_to=None):
+    """Tables of the properties history that may have rows in [date_from, date_to)."""
+    return [DevicePropertyHistory.__table__] + history_partitions.covering(db, date_from, date_to)
+
+
+def history_union(db, date_from=None, date_to=None):
+    """Properties history in [date_from, date_to), as an alias of the union of the tables covering it.
+
+    SQLite applies the other conditions of a query on the alias to each table, through its indexes, as long as they
+    compare to constants: correlated subqueries have to be written for each table of history_tables.
+    """
+    selects = []
+    for table in history_tables(db, date_from, date_to):
+        select = sqlalchemy.select([
+            table.c.id, table.c.device_id, table.c.report_id, table.c.date, table.c.name, table.c.value
+        ])
+        if date_from is not None:
+            select = select.where(table.c.date >= date_from)
+        if date_to is not None:
+            select = select.where(table.c.date < date_to)
+        selects.append(select)
+    if len(selects) == 1:
+        return selects[0].alias()
+    return sqlalchemy.union_all(*selects).alias()
+
+
+def history_insert(db, history):
+    """Writes history rows to the tables of their months. The transaction has to be IMMEDIATE."""
+    months = collections.defaultdict(list)
+    for row in history:
+        months[history_partitions.month(row["date"])].append(row)
+    for month, rows in sorted(months.iteritems()):
+        # Two reports of different types at the same date would violate the history unique index
+        history_partitions.insert(db, month, rows, "OR IGNORE")
+
+
+# The config table is read once, conf_set keeps this cache up to date
+conf_cache = None
+conf_parsed = {}
+
+# Changed on every conf_set, so that other processes know they have to reload the config
+CONF_STAMP = ".config_stamp"
+
+
+def conf_load():
+        global conf_cache
+        conf_cache = dict(session.query(Config.name, Config.value))
+        conf_parsed.clear()
+
+
+def conf_refresh():
+        """Reloads the config if it was changed by another process."""
+        stamp = session.query(Config.value).filter(Config.name == CONF_STAMP).scalar()
+        if conf_cache is None or stamp != conf_cache.get(CONF_STAMP):
+            conf_load()
+        session.remove()
 
 
 def conf_get(name, default=None):
-        conf = session.query(Config).filter(Config.name == name).first()
-        if conf:
-            return conf.value
+        if conf_cache is None:
+            conf_load()
+        if name in conf_cache:
+            return conf_cache[name]
         else:
             if default:  # We can easily see the default values in the GUI this way
                 conf_set(name, default)
             return default
 
 
+def conf_get_list(name, default=None):
+        """Comma separated list parameter, it is only split once."""
+        key = (name, list)
+        if key not in conf_parsed:
+            conf_parsed[key] = [v.strip() for v in (conf_get(name, default) or "").split(',') if v.strip()]
+        return conf_parsed[key]
+
+
+def conf_get_bool(name, default=None):
+        key = (name, bool)
+        if key not in conf_parsed:
+            conf_parsed[key] = (conf_get(name, default) or "").strip().lower() in ("true", "yes", "on", "1")
+        return conf_parsed[key]
+
+
 def conf_set(name, value):
         conf = session.query(Config).filter(Config.name == name).first()
         if not conf:
             conf = Config(name=name)
             session.add(conf)
         conf.value = value
+        stamp = uuid.uuid4().hex
+        session.merge(Config(name=CONF_STAMP, value=stamp))
         session.commit()
+        if conf_cache is not None:
+            conf_cache[name] = value
+            conf_cache[CONF_STAMP] = stamp
+            conf_parsed.clear()
+
+
+class SessionHandler(tornado.web.RequestHandler):
+    """Handler using the database, each request gets a new session."""
+    def prepare(self):
+        # Objects (or a failed transaction) of a previous request must not be seen by this one
+        session.remove()
+        metrics.sql_start()
+        profiler.start()
+
+    def on_finish(self):
+        session.remove()
+
+
+PASSWORD_ITERATIONS = 100000
+
+
+def _pbkdf2_hmac(hash_name, password, salt, iterations):
+    """hashlib.pbkdf2_hmac, which Python only has since 2.7.8 (debian wheezy has 2.7.3)."""
+    inner = hashlib.new(hash_name)
+    outer = hashlib.new(hash_name)
+    if len(password) > inner.block_size:
+        password = hashlib.new(hash_name, password).digest()
+    password = password.ljust(inner.block_size, "\0")
+    inner.update(password.translate(hmac.trans_36))
+    outer.update(password.translate(hmac.trans_5C))
+
+    def prf(data):
+        h = inner.copy()
+        h.update(data)
+        o = outer.copy()
+        o.update(h.digest())
+        return o.digest()
+
+    # A single block, the key is as long as the hash
+    u = prf(salt + "\0\0\0\1")
+    result = int(base64.b16encode(u), 16)
+    for _i in xrange(iterations - 1):
+        u = prf(u)
+        result ^= int(base64.b16encode(u), 16)
+    return base64.b16decode("{0:0{1}X}".format(result, inner.digest_size * 2))
+
+
+def _compare_digest(a, b):
+    """hmac.compare_digest, which Python only has since 2.7.7: the time doesn't depend on where a and b differ."""
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+pbkdf2_hmac = getattr(hashlib, "pbkdf2_hmac", _pbkdf2_hmac)
+compare_digest = getattr(hmac, "compare_digest", _compare_digest)
+
+
+def password_hash(password, salt=None, iterations=PASSWORD_ITERATIONS):
+    """Salted PBKDF2 hash of a password, as pbkdf2_sha256$iterations$salt$hash."""
+    if salt is None:
+        salt = base64.b16encode(os.urandom(16)).lower()
+    hash = pbkdf2_hmac("sha256", password.encode("utf-8"), str(salt), iterations)
+    return "pbkdf2_sha256${iterations}${salt}${hash}".format(
+        iterations=iterations, salt=salt, hash=base64.b16encode(hash).lower())
+
+
+def password_check(stored, password):
+    """Checks a password against its stored hash, which may be an unsalted SHA-1 of older versions."""
+    if not stored:
+        return False
+    stored = str(stored)
+    if stored.startswith("pbkdf2_sha256$"):
+        algorithm, iterations, salt, hash = stored.split("$")
+        return compare_digest(stored, password_hash(password, salt, int(iterations)))
+    return compare_digest(stored, hashlib.sha1(password.encode("utf-8")).hexdigest())
+
+
+UserInfo = collections.namedtuple("UserInfo", ["id", "name", "right"])
+
+
+class UserCache(object):
+    """Users by id for a few seconds, so that the pages and their API calls don't read them on each request.
+
+    The users page invalidates the users it changes, other processes see the changes once they expire.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            expires, user = self.users.get(user_id, (0, None))
+        if expires > time.time():
+            return user
+        row = session.query(User.id, User.name, User.right).filter(User.id == user_id).first()
+        user = UserInfo(*row) if row else None
+        with self.lock:
+            self.users[user_id] = (time.time() + self.ttl, user)
+        return user
 
-
-def get_or_create_device(ident):
-    device = session.query(Device).filter(Device.ident == ident).first()
-    if not device:
-        device = Device(
-            ident=ident,
-            date_updated=datetime.utcnow(),
-            date_created=datetime.utcnow()
-        )
-    session.add(device)
-    return device
+    def invalidate(self, user_id):
+        with self.lock:
+            self.users.pop(user_id, None)
+
+user_cache = UserCache(args.auth_cache_ttl)
 
 
-class SecureHandler(tornado.web.RequestHandler):
+class SecureHandler(SessionHandler):
     def get_current_user(self):
-        userId = self.get_secure_cookie("user_id")
-        return session.query(User).filter(User.id == userId).first()
+        """Called once per request by tornado (current_user)."""
+        user_id = self.get_secure_cookie("user_id")
+        if not user_id or not user_id.isdigit():
+            return None
+        return user_cache.get(int(user_id))
 
     def has_right(self, right):
-        user = self.get_current_user()
+        user = self.current_user
         if not user or user.right < right:
+            # This finishes the response, nothing else can be written
             self.redirect('/login')
-            self.finish()  # We don't want anyone to continue writing the response
             return False
         else:
             return True
@@ -217,30 +976,309 @@ class SecureHandler(tornado.web.RequestHandler):
         return self.has_right(User.RIGHT_ADMIN)
 
 
-class DeviceById(SecureHandler):
+class DevicesSearchApi(SecureHandler):
+    """Devices having all the given property values (current ones), most recently created first."""
+    def get(self):
+        if not self.check_access_right():
+            return
+        arguments = dict(self.request.arguments)
+        nb = min(parse_int(arguments.pop("nb", [50])[0], "nb"), 500)
+        before = arguments.pop("before", None)
+        if not arguments:
+            raise tornado.web.HTTPError(400, "No property to search")
+        before = parse_int(before[0], "before") if before else None
+        ids = list(itertools.islice(intersect(device_postings(arguments), before), nb + 1))
+        link_next = None
+        if len(ids) > nb:
+            ids.pop()
+            arguments["before"] = [ids[-1] - 1]
+            arguments["nb"] = [nb]
+            link_next = "/api/devices/search?" + urllib.urlencode(arguments, doseq=True)
+        devices = dict((d.id, d) for d in session.query(Device.id, Device.ident).filter(Device.id.in_(ids)))
+        self.write({
+            "devices": [{"id": id, "ident": devices[id].ident} for id in ids if id in devices],
+            "next": link_next
+        })
+
+
+def device_lookup(id):
+    """Device by ident or by id, an ident matching the id of an other device wins."""
+    condition = Device.ident == id
+    if id.isdigit():
+        condition = sqlalchemy.or_(condition, Device.id == int(id))
+    devices = session.query(Device).filter(condition).all()
+    if not devices:
+        return None
+    return min(devices, key=lambda d: d.ident != id)
+
+
+def device_properties(device_id):
+    return session.query(DeviceProperty.name, DeviceProperty.value)\
+        .filter(DeviceProperty.device_id == device_id)\
+        .order_by(DeviceProperty.name)\
+        .all()
+
+
+def device_reports(device_id, before_date=None, before_id=None, nb=50):
+    """Reports of a device, from the most recent one, with keyset pagination on (date, id)."""
+    query = session.query(DeviceReport.id, DeviceReport.date, DeviceReport.type)\
+        .filter(DeviceReport.device_id == device_id)
+    if before_date and before_id:
+        query = query.filter(sqlalchemy.or_(
+            DeviceReport.date < before_date,
+            sqlalchemy.and_(DeviceReport.date == before_date, DeviceReport.id < before_id)))
+    reports = query.order_by(DeviceReport.date.desc(), DeviceReport.id.desc()).limit(nb + 1).all()
+    link_next = None
+    if len(reports) > nb:
+        reports.pop()
+        link_next = "?" + urllib.urlencode({"before_date": str(reports[-1].date), "before_id": reports[-1].id, "nb": nb})
+    return reports, link_next
+
+
+class DeviceReportsMixin(object):
+    def reports(self, device_id):
+        before_date = self.get_argument("before_date", None)
+        before_id = self.get_argument("before_id", None)
+        return device_reports(
+            device_id,
+            parse_date(before_date) if before_date else None,
+            int(before_id) if before_id else None,
+            min(int(self.get_argument("nb", 50)), 500)
+        )
+
+
+class RenderCache(object):
+    """Rendered pages by ETag (LRU), bounded by their total size in bytes."""
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.pages = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, etag):
+        with self.lock:
+            body = self.pages.pop(etag, None)
+            if body is not None:
+                self.pages[etag] = body
+            return body
+
+    def put(self, etag, body):
+        if len(body) > self.size:
+            return
+        with self.lock:
+            previous = self.pages.pop(etag, None)
+            if previous is not None:
+                self.used -= len(previous)
+            self.pages[etag] = body
+            self.used += len(body)
+            while self.used > self.size:
+                self.used -= len(self.pages.popitem(last=False)[1])
+
+render_cache = RenderCache(args.render_cache_size * 1024 * 1024)
+
+
+class ConditionalMixin(object):
+    """Conditional GET of the pages whose content is fully described by a few cheap values (the validator).
+
+    The ETag is derived from the validator and the URL, so that the client gets a 304 and the other clients the
+    already rendered page before the heavy queries and the rendering. The pages are the same for every user.
+    """
+    def not_modified(self, validator, last_modified=None):
+        """Sets the validation headers, True if the response was already sent."""
+        key = repr((self.__class__.__name__, self.request.uri, validator))
+        self.etag = '"{h}"'.format(h=hashlib.sha1(key).hexdigest())
+        self.set_header("Etag", self.etag)
+        self.set_header("Cache-Control", "private, no-cache")
+        if last_modified:
+            self.set_header("Last-Modified", last_modified)
+        if self.check_etag_header():
+            metrics.inc("edms_render_cache_total", outcome="not_modified")
+            self.set_status(304)
+            self.finish()
+            return True
+        body = render_cache.get(self.etag)
+        if body is not None:
+            metrics.inc("edms_render_cache_total", outcome="hit")
+            self.finish(body)
+            return True
+        metrics.inc("edms_render_cache_total", outcome="miss")
+        return False
+
+    def render_cached(self, template_name, **kwargs):
+        body = self.render_string(template_name, **kwargs)
+        render_cache.put(self.etag, body)
+        self.finish(body)
+
+
+class DeviceById(SecureHandler, DeviceReportsMixin, ConditionalMixin):
     def get(self, id):
-        self.check_access_right()
-        device = session.query(Device).filter(Device.ident == id).first()
-        if not device:
-            device = session.query(Device).filter(Device.id == int(id)).first()
+        if not self.check_access_right():
+            return
+        device = device_lookup(id)
         if device:
-            properties = session.query(DeviceProperty)\
-                .filter(DeviceProperty.device_id == device.id)\
-                .order_by(DeviceProperty.name)\
-                .all()
-            logs = session.query(DeviceReport).filter(DeviceReport.device_id == device.id)\
-                .order_by(DeviceReport.date.desc())\
-                .all()
-            self.render("device.html", title=_("Device ")+device.ident, device=device, properties=properties, logs=logs)
+            logs, link_next = self.reports(device.id)
+            # The properties and the log only change with the version of the device
+            validator = (
+                device.id, device.ident, device.version, device.date_updated, device.date_seen,
+                [(log.id, log.date, log.type) for log in logs], link_next
+            )
+            if self.not_modified(validator, max(device.date_updated, device.date_seen or device.date_updated)):
+                return
+            properties = device_properties(device.id)
+            self.render_cached(
+                "device.html",
+                title=_("Device ")+device.ident,
+                device=device,
+                properties=properties,
+                logs=logs,
+                logs_next="/api/device/{id}/reports{args}".format(id=device.id, args=link_next) if link_next else None
+            )
         else:
             self.render("error.html", title=_("Device not found"), error=_("Device was not found"))
 
 
-class Devices(SecureHandler):
+class DeviceReportsApi(SecureHandler, DeviceReportsMixin):
+    """Report log of a device, the device page uses it to load the older reports."""
+    def get(self, id):
+        if not self.check_access_right():
+            return
+        reports, link_next = self.reports(int(id))
+        self.write({
+            "reports": [{"id": r.id, "date": str(r.date), "type": r.type} for r in reports],
+            "next": "/api/device/{id}/reports{args}".format(id=id, args=link_next) if link_next else None
+        })
+
+
+def parse_date(value):
+    """Parses a date given as argument, the time and its microseconds are optional."""
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise tornado.web.HTTPError(400, "Incorrect date format: %s", value)
+
+
+def parse_int(value, name):
+    """Parses an integer given as argument."""
+    try:
+        return int(value)
+    except ValueError:
+        raise tornado.web.HTTPError(400, "Incorrect %s: %s", name, value)
+
+
+class Devices(SecureHandler, ConditionalMixin):
+    SORTS = ("id", "date_seen")
+
+    def query(self, nb=50):
+        """Keyset pagination: a page starts after the last device of the previous one.
+
+        Only the displayed columns are fetched, it doesn't matter how many devices we have.
+        """
+        nb = min(parse_int(self.get_argument("nb", nb), "nb"), 500)
+        sort = self.get_argument("sort", "id")
+        if sort not in self.SORTS:
+            raise tornado.web.HTTPError(400, "Unknown sort: %s", sort)
+        desc = self.get_argument("order", "desc" if sort == "date_seen" else "asc") == "desc"
+        search = self.get_argument("q", "")
+        group_id = self.get_argument("group_id", None)
+
+        query = session.query(
+            Device.id, Device.ident, Device.date_created, Device.date_seen, DeviceGroup.name.label("group_name")
+        ).outerjoin(DeviceGroup, DeviceGroup.id == Device.group_id)
+
+        # Ident prefix, as a range so that the ident index is used
+        if search:
+            query = query.filter(Device.ident >= search, Device.ident < search + u"\uffff")
+
+        # Devices of the group and of its subgroups
+        if group_id:
+            query = query.filter(Device.group_id.in_(group_subtree(parse_int(group_id, "group_id"))))
+
+        after_id = self.get_argument("after_id", None)
+        after_id = parse_int(after_id, "after_id") if after_id else None
+        if sort == "id":
+            if after_id is not None:
+                query = query.filter(Device.id < after_id if desc else Device.id > after_id)
+            query = query.order_by(Device.id.desc() if desc else Device.id)
+        else:
+            # Devices only known by their events were never seen: SQLite sorts them first in ascending order and last
+            # in descending order, a page ending with one of them has no after_date
+            after_date = self.get_argument("after_date", None)
+            if after_id is not None and after_date:
+                after_date = parse_date(after_date)
+                if desc:
+                    query = query.filter(sqlalchemy.or_(
+                        Device.date_seen < after_date,
+                        sqlalchemy.and_(Device.date_seen == after_date, Device.id < after_id),
+                        Device.date_seen.is_(None)))
+                else:
+                    query = query.filter(sqlalchemy.or_(
+                        Device.date_seen > after_date,
+                        sqlalchemy.and_(Device.date_seen == after_date, Device.id > after_id)))
+            elif after_id is not None:
+                if desc:
+                    query = query.filter(Device.date_seen.is_(None), Device.id < after_id)
+                else:
+                    query = query.filter(sqlalchemy.or_(
+                        Device.date_seen.isnot(None),
+                        sqlalchemy.and_(Device.date_seen.is_(None), Device.id > after_id)))
+            if desc:
+                query = query.order_by(Device.date_seen.desc(), Device.id.desc())
+            else:
+                query = query.order_by(Device.date_seen, Device.id)
+
+        devices = query.limit(nb + 1).all()
+
+        link_next = None
+        if len(devices) > nb:
+            devices.pop()
+            last = devices[-1]
+            arguments = {"sort": sort, "order": "desc" if desc else "asc", "nb": nb, "after_id": last.id}
+            if search:
+                arguments["q"] = search
+            if group_id:
+                arguments["group_id"] = group_id
+            if sort == "date_seen" and last.date_seen:
+                arguments["after_date"] = str(last.date_seen)
+            link_next = "?" + urllib.urlencode(arguments)
+
+        return devices, sort, desc, search, link_next
+
+    def get(self):
+        if not self.check_access_right():
+            return
+        devices, sort, desc, search, link_next = self.query()
+        # The page is a keyset page of the displayed columns only, its rows are the validator
+        if self.not_modified((devices, link_next), max([d.date_seen for d in devices if d.date_seen] or [None])):
+            return
+        self.render_cached(
+            "devices.html",
+            title=_("Devices"),
+            devices=devices,
+            sort=sort, desc=desc, search=search,
+            paging_next=link_next
+        )
+
+
+class DevicesApi(Devices):
+    """Devices list for scripts, same arguments as the devices page."""
     def get(self):
-        self.check_access_right()
-        devices = session.query(Device).all()
-        self.render("devices.html", title=_("Devices"), devices=devices)
+        if not self.check_access_right():
+            return
+        devices, sort, desc, search, link_next = self.query()
+        self.write({
+            "devices": [
+                {
+                    "id": device.id,
+                    "ident": device.ident,
+                    "group": device.group_name,
+                    "date_created": str(device.date_created),
+                    "date_seen": str(device.date_seen) if device.date_seen else None
+                } for device in devices
+            ],
+            "next": "/api/devices" + link_next if link_next else None
+        })
 
 
 class Index(tornado.web.RequestHandler):
@@ -266,155 +1304,1237 @@ def json_flatten(data):
     return sub
 
 
-class DeviceReportPage(tornado.web.RequestHandler):
-    def post(self):
-        conf_possible_ident = conf_get("report_possible_ident_fields", "ident,hostname").split(',')
-        data = tornado.escape.json_decode(self.request.body)
+def chunks(values, size=500):
+    """Splits values in lists, SQLite doesn't accept more than 999 parameters per request."""
+    values = iter(values)
+    while True:
+        chunk = list(itertools.islice(values, size))
+        if not chunk:
+            return
+        yield chunk
 
-        ident = None
 
-        for name in conf_possible_ident:
-            value = data.get(name)
-            if value:
-                ident = name+":"+value
-                break
+class ReportError(Exception):
+    """Report that can't be accepted, the message is sent back to the device."""
+    def __init__(self, message, extra=None, status=400):
+        Exception.__init__(self, message)
+        self.message = message
+        self.extra = extra
+        self.status = status
 
-        date = data.get('date')
-        type = data.get('type')
-        if not date:
-            self.set_status(400)
-            self.write(
-                {
-                    "status": "error",
-                    "message": "No date specified"
-                }
+    def count(self, metric="edms_reports_total"):
+        metrics.inc(metric, outcome="error", reason=self.message)
+
+    def to_dict(self):
+        error = {
+            "status": "error",
+            "message": self.message
+        }
+        if self.extra:
+            error.update(self.extra)
+        return error
+
+
+def device_ident(data):
+    """Ident of a device, from the first of the report_possible_ident_fields it has as a string."""
+    for name in conf_get_list("report_possible_ident_fields", "ident,hostname"):
+        value = data.get(name)
+        if value and isinstance(value, basestring):
+            return name+":"+value
+    return None
+
+
+# As strptime with '%Y-%m-%d %H:%M:%S.%f', the fields don't need their leading zeros
+REPORT_DATE = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})\s+(\d{1,2}):(\d{1,2}):(\d{1,2})(?:\.(\d{1,6}))?$')
+
+
+def report_date(value, microseconds=True):
+    """Parses the date of a report or of an event, the microseconds are optional unless microseconds is set."""
+    match = REPORT_DATE.match(value)
+    if not match or (microseconds and match.group(7) is None):
+        raise ValueError("Incorrect date format")
+    year, month, day, hour, minute, second, fraction = match.groups()
+    return datetime(
+        int(year), int(month), int(day), int(hour), int(minute), int(second),
+        int(fraction.ljust(6, '0')) if fraction else 0
+    )
+
+
+def report_parse(data):
+    """Extracts the ident, date, type and device group of a decoded report."""
+    if not isinstance(data, dict):
+        raise ReportError("Report must be a JSON object")
+
+    ident = device_ident(data)
+
+    date = data.get('date')
+    type = data.get('type')
+    if not date:
+        raise ReportError("No date specified")
+
+    del data['date']
+
+    try:
+        date = report_date(date)
+    except (ValueError, TypeError):
+        raise ReportError("Incorrect date format")
+
+    if not ident:
+        raise ReportError("No identifier could be found", {
+            "possible identifiers": conf_get_list("report_possible_ident_fields", "ident,hostname")
+        })
+
+    if type:
+        del data['type']
+    else:
+        type = '_'
+
+    # We will try to attach this device to a group of devices
+    group_ident = data.get(conf_get("report_possible_device_group_field", "device_group"))
+    group_auto_create = conf_get_bool("device_group_auto_create", "false")
+    history_changes_only = conf_get_bool("report_history_changes_only", "false")
+
+    if conf_get_bool("report_json_flatten", "true"):
+        data = json_flatten(data)
+
+    return {
+        "ident": ident,
+        "date": date,
+        "type": type,
+        "group_ident": group_ident,
+        "group_auto_create": group_auto_create,
+        "history_changes_only": history_changes_only,
+        "data": data
+    }
+
+
+def store_reports(reports, db=None):
+    """Stores some parsed reports in a single transaction.
+
+    Devices, groups and already received reports are fetched once for the whole batch and the reports, properties
+    history and properties are written with set-based inserts. One status is returned per report.
+
+    The configuration was read when parsing the reports, so that they can be stored from any thread.
+    """
+    if db is None:
+        db = session
+    now = datetime.utcnow()
+    statuses = []
+    begin_write(db)
+    try:
+        # Devices, their rows are then fetched by primary key
+        device_ids = device_idents.get_or_create(db, set(r['ident'] for r in reports), now)
+        devices_by_id = {}
+        for ids in chunks(set(device_ids.itervalues())):
+            for device in db.query(Device).filter(Device.id.in_(ids)):
+                devices_by_id[device.id] = device
+        devices = dict((ident, devices_by_id[device_id]) for ident, device_id in device_ids.iteritems())
+
+        # Groups
+        groups = {}
+        new_groups = []
+        group_idents = set(r['group_ident'] for r in reports if r['group_ident'])
+        for idents in chunks(group_idents):
+            for group in db.query(DeviceGroup).filter(DeviceGroup.ident.in_(idents)):
+                groups[group.ident] = group
+        for report in reports:
+            group_ident = report['group_ident']
+            if group_ident and group_ident not in groups and report['group_auto_create']:
+                group = DeviceGroup(name=group_ident, ident=group_ident, depth=0)
+                db.add(group)
+                groups[group_ident] = group
+                new_groups.append(group)
+
+        db.flush()
+        if new_groups:
+            group_tree_add(db, [group.id for group in new_groups])
+
+        group_devices = collections.Counter()
+        for report in reports:
+            device = devices[report['ident']]
+            report['device_id'] = device.id
+            # Reports older than the last one received can't be compared to the current properties
+            report['late'] = device.date_seen is not None and report['date'] < device.date_seen
+            if not device.date_seen or report['date'] > device.date_seen:
+                device.date_seen = report['date']
+            group = groups.get(report['group_ident'])
+            if group and device.group_id != group.id:
+                if device.group_id:
+                    group_devices[device.group_id] -= 1
+                group_devices[group.id] += 1
+                device.group_id = group.id
+            report['group_id'] = device.group_id
+        group_stats_update(db, group_devices, reports, devices)
+
+        # Reports
+        report_ids = _report_ids(db, reports)
+        new_reports = []
+        for report in reports:
+            key = (report['device_id'], report['date'], report['type'])
+            report['new'] = key not in report_ids
+            if report['new']:
+                report_ids[key] = None  # The same report may be sent twice in the same batch
+                new_reports.append(report)
+        if new_reports:
+            db.execute(
+                DeviceReport.__table__.insert(),
+                [{"device_id": r['device_id'], "date": r['date'], "type": r['type']} for r in new_reports]
+            )
+            report_ids.update(_report_ids(db, new_reports))
+        for report in reports:
+            report['id'] = report_ids[(report['device_id'], report['date'], report['type'])]
+
+        # Properties history, we only fetch the already stored properties of the reports we already had
+        stored = set()
+        resent = [r for r in reports if not r['new'] and not r['history_changes_only']]
+        if resent:
+            stored_history = history_union(
+                db, min(r['date'] for r in resent), max(r['date'] for r in resent) + timedelta(microseconds=1)
+            )
+            for ids in chunks(set(r['id'] for r in resent)):
+                stored.update(
+                    db.query(stored_history.c.report_id, stored_history.c.name)
+                    .filter(stored_history.c.report_id.in_(ids))
+                )
+        history = []
+        properties = {}
+        current = properties_cache.get_many(
+            db, set(r['device_id'] for r in reports if r['history_changes_only'])
+        )
+        for report in reports:
+            changes = report['new']
+            if not report['history_changes_only']:
+                for name, value in report['data'].iteritems():
+                    value = tornado.escape.json_encode(value)
+                    if (report['id'], name) not in stored:
+                        stored.add((report['id'], name))
+                        changes = True
+                        history.append(_history_row(report, name, value))
+                    # We only take the last value as the current one
+                    properties[(report['device_id'], name)] = value
+            elif report['new'] and report['late']:
+                if not _late_history(db, report, history):
+                    device_properties = current[report['device_id']]
+                    for name, value in report['data'].iteritems():
+                        value = tornado.escape.json_encode(value)
+                        device_properties[name] = value
+                        properties[(report['device_id'], name)] = value
+            elif report['new']:
+                # Only the values that differ from the current ones are stored
+                device_properties = current[report['device_id']]
+                for name, value in report['data'].iteritems():
+                    value = tornado.escape.json_encode(value)
+                    if device_properties.get(name) != value:
+                        device_properties[name] = value
+                        history.append(_history_row(report, name, value))
+                        properties[(report['device_id'], name)] = value
+
+            device = devices[report['ident']]
+            if changes:
+                device.version = (device.version or 0) + 1
+                if report['date'] > device.date_updated:
+                    device.date_updated = report['date']
+
+            metrics.observe("edms_report_properties", len(report['data']))
+            if changes:
+                statuses.append({"status": "ok"})
+                metrics.inc("edms_reports_total", outcome="ok")
+            else:
+                statuses.append({"status": "ok", "already_sent": True})
+                metrics.inc("edms_reports_total", outcome="already_sent")
+
+        if history:
+            history_insert(db, history)
+        hours = set(r['date'].replace(minute=0, second=0, microsecond=0) for r in reports if r['new'])
+        if hours:
+            db.execute(
+                DevicePropertyRollupPending.__table__.insert().prefix_with("OR IGNORE"),
+                [{"date": hour} for hour in hours]
+            )
+        if properties:
+            db.execute(
+                DeviceProperty.__table__.insert().prefix_with("OR REPLACE"),
+                [{"device_id": k[0], "name": k[1], "value": v} for k, v in properties.iteritems()]
             )
-            return
 
-        del data['date']
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        history_partitions.rollback()
+        metrics.inc("edms_ingest_integrity_rollbacks_total")
+        raise
+    except:
+        db.rollback()
+        history_partitions.rollback()
+        raise
+
+    device_idents.update(device_ids)
+    properties_cache.update(current)
+    properties_cache.discard(set(r['device_id'] for r in reports if not r['history_changes_only']))
+    report_feed.publish_threadsafe([r for r in reports if r['new']])
+
+    return statuses
+
+
+def group_tree_add(db, group_ids):
+    """Adds some new groups without parent to the hierarchy."""
+    db.execute(
+        DeviceGroupTree.__table__.insert(),
+        [{"ancestor_id": group_id, "descendant_id": group_id, "distance": 0} for group_id in group_ids]
+    )
+    db.execute(
+        DeviceGroupStats.__table__.insert().prefix_with("OR IGNORE"),
+        [{"group_id": group_id, "device_count": 0, "seen_24h": 0} for group_id in group_ids]
+    )
+
+
+def group_tree_rebuild(db):
+    """Rebuilds the closure table and the depth of the groups from their parents.
+
+    Groups only change from the groups page, recomputing the whole hierarchy is simpler than moving subtrees.
+    """
+    parents = dict(db.query(DeviceGroup.id, DeviceGroup.parent_id))
+    tree = []
+    depths = []
+    for group_id in parents:
+        ancestor_id = group_id
+        distance = 0
+        # The groups page refuses cycles, this only protects us from looping forever on one
+        while ancestor_id in parents and distance <= len(parents):
+            tree.append({"ancestor_id": ancestor_id, "descendant_id": group_id, "distance": distance})
+            ancestor_id = parents[ancestor_id]
+            distance += 1
+        depths.append({"group_id": group_id, "group_depth": distance - 1})
+    db.execute(DeviceGroupTree.__table__.delete())
+    if tree:
+        db.execute(DeviceGroupTree.__table__.insert(), tree)
+        db.execute(
+            DeviceGroup.__table__.update()
+            .where(DeviceGroup.id == sqlalchemy.bindparam("group_id"))
+            .values(depth=sqlalchemy.bindparam("group_depth")),
+            depths
+        )
+        db.execute(DeviceGroupStats.__table__.insert().prefix_with("OR IGNORE").from_select(
+            ["group_id", "device_count", "seen_24h"],
+            sqlalchemy.select([DeviceGroup.id, sqlalchemy.literal(0), sqlalchemy.literal(0)])
+        ))
+
+
+def group_subtree(group_id):
+    """Ids of a group and of all its subgroups."""
+    return sqlalchemy.select([DeviceGroupTree.descendant_id]).where(DeviceGroupTree.ancestor_id == group_id)
+
+
+def group_stats_update(db, group_devices, reports, devices):
+    """Applies the changes of the devices count and the last report date of the groups."""
+    stats = DeviceGroupStats.__table__
+    counts = [{"group": group_id, "delta": delta} for group_id, delta in group_devices.iteritems() if delta]
+    if counts:
+        db.execute(
+            stats.update().where(stats.c.group_id == sqlalchemy.bindparam("group"))
+            .values(device_count=stats.c.device_count + sqlalchemy.bindparam("delta")),
+            counts
+        )
+    dates = {}
+    for report in reports:
+        group_id = devices[report['ident']].group_id
+        if group_id and (group_id not in dates or report['date'] > dates[group_id]):
+            dates[group_id] = report['date']
+    if dates:
+        db.execute(
+            stats.update().where(sqlalchemy.and_(
+                stats.c.group_id == sqlalchemy.bindparam("group"),
+                sqlalchemy.or_(
+                    stats.c.last_report_date.is_(None),
+                    stats.c.last_report_date < sqlalchemy.bindparam("date")
+                )
+            )).values(last_report_date=sqlalchemy.bindparam("date")),
+            [{"group": group_id, "date": date} for group_id, date in dates.iteritems()]
+        )
 
-        date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S.%f')
-        if not date:
-            self.set_status(400)
-            self.write(
-                {
-                    "status": "error",
-                    "message": "Incorrect date format"
-                }
+
+def group_stats_refresh():
+    """Counts the devices seen in the last 24 hours, which changes with time and not only at ingest."""
+    try:
+        seen = session.query(Device.group_id, sqlalchemy.func.count()).filter(
+            Device.date_seen >= datetime.utcnow() - timedelta(days=1),
+            Device.group_id.isnot(None)
+        ).group_by(Device.group_id).all()
+        stats = DeviceGroupStats.__table__
+        begin_write(session)
+        session.execute(stats.update().values(seen_24h=0))
+        if seen:
+            session.execute(
+                stats.update().where(stats.c.group_id == sqlalchemy.bindparam("group"))
+                .values(seen_24h=sqlalchemy.bindparam("seen")),
+                [{"group": group_id, "seen": nb} for group_id, nb in seen]
             )
-            return
+        session.commit()
+    except Exception:
+        session.rollback()
+        app_log.exception("Groups stats refresh failed")
+    finally:
+        session.remove()
+
+
+def group_backfill():
+    """The hierarchy and the stats of the groups created before they existed are computed once."""
+    if not session.query(DeviceGroup.id).first() or session.query(DeviceGroupTree.ancestor_id).first():
+        return
+    print("Computing the groups hierarchy and stats...")
+    begin_write(session)
+    group_tree_rebuild(session)
+    stats = DeviceGroupStats.__table__
+    session.execute(stats.insert().prefix_with("OR REPLACE").from_select(
+        ["group_id", "device_count", "seen_24h", "last_report_date"],
+        sqlalchemy.select([
+            Device.group_id, sqlalchemy.func.count(), sqlalchemy.literal(0), sqlalchemy.func.max(Device.date_seen)
+        ]).where(Device.group_id.in_(sqlalchemy.select([DeviceGroup.id]))).group_by(Device.group_id)
+    ))
+    session.commit()
+    group_stats_refresh()
+
+
+def _history_row(report, name, value):
+    return {
+        "device_id": report['device_id'],
+        "report_id": report['id'],
+        "date": report['date'],
+        "name": name,
+        "value": value
+    }
+
+
+def _late_history(db, report, history):
+    """Changes only history of a report older than the last report of its device.
+
+    Its values are compared to the ones in effect at its date, and the values it replaced are stated again at the next
+    report of the device so that they still apply after it. The next report is returned, there is none when the device
+    was only seen by its events since then.
+    """
+    if history:  # The properties in effect might depend on the pending rows
+        history_insert(db, history)
+        del history[:]
+
+    before = dict((p.name, p.value) for p in properties_at(db, report['device_id'], report['date']))
+    following = db.query(DeviceReport.id, DeviceReport.date).filter(
+        DeviceReport.device_id == report['device_id'],
+        DeviceReport.date > report['date']
+    ).order_by(DeviceReport.date).first()
+
+    for name, value in report['data'].iteritems():
+        value = tornado.escape.json_encode(value)
+        if before.get(name) == value:
+            continue
+        history.append(_history_row(report, name, value))
+        if following and name in before:
+            history.append({
+                "device_id": report['device_id'],
+                "report_id": following.id,
+                "date": following.date,
+                "name": name,
+                "value": before[name]
+            })
+    return following
+
+
+def properties_at(db, device_id, date):
+    """Properties in effect for a device at a given date.
+
+    It also works when only the changes of the properties are stored.
+    """
+    history = history_union(db, None, date + timedelta(microseconds=1))
+    # SQLite takes the value of the row having the max date
+    return db.query(history.c.name, history.c.value, sqlalchemy.func.max(history.c.date))\
+        .filter(history.c.device_id == device_id)\
+        .group_by(history.c.name)\
+        .order_by(history.c.name)\
+        .all()
+
+
+class PropertiesCache(object):
+    """Current properties of the most recently seen devices (LRU), to detect changes without any request."""
+    def __init__(self, size):
+        self.size = size
+        self.devices = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, db, device_ids):
+        """Copies of the properties of some devices, the missing ones are loaded in one request."""
+        result = {}
+        with self.lock:
+            for device_id in device_ids:
+                properties = self.devices.pop(device_id, None)
+                if properties is not None:
+                    self.devices[device_id] = properties
+                    result[device_id] = dict(properties)
+        missing = [device_id for device_id in device_ids if device_id not in result]
+        for device_id in missing:
+            result[device_id] = {}
+        for ids in chunks(missing):
+            query = db.query(DeviceProperty.device_id, DeviceProperty.name, DeviceProperty.value)\
+                .filter(DeviceProperty.device_id.in_(ids))
+            for device_id, name, value in query:
+                result[device_id][name] = value
+        return result
+
+    def update(self, properties):
+        """Saves the properties of some devices once they are committed."""
+        with self.lock:
+            for device_id, device_properties in properties.iteritems():
+                self.devices.pop(device_id, None)
+                self.devices[device_id] = device_properties
+            while len(self.devices) > self.size:
+                self.devices.popitem(last=False)
+
+    def discard(self, device_ids):
+        with self.lock:
+            for device_id in device_ids:
+                self.devices.pop(device_id, None)
+
+properties_cache = PropertiesCache(args.property_cache_size)
+
+
+class NameIds(object):
+    """Ids of the most recently used rows of a table by their unique name (LRU).
+
+    Devices and event types are never renamed nor deleted, so the ids stay valid when other processes create rows.
+    """
+    def __init__(self, name_column, id_column, size, new_row):
+        self.name_column = name_column
+        self.id_column = id_column
+        self.size = size
+        self.new_row = new_row
+        self.ids = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def preload(self, db, order_by):
+        """Loads the first rows in that order."""
+        query = db.query(self.name_column, self.id_column).order_by(order_by).limit(self.size)
+        self.update(collections.OrderedDict(reversed(query.all())))
+
+    def get_or_create(self, db, names, now):
+        """Ids of some rows, the missing ones are created.
+
+        This has to be called in an IMMEDIATE transaction: nobody else can create the same rows before it ends.
+        The ids of the created rows must only be cached once it is committed.
+        """
+        result = {}
+        with self.lock:
+            for name in names:
+                row_id = self.ids.pop(name, None)
+                if row_id is not None:
+                    self.ids[name] = row_id
+                    result[name] = row_id
+        missing = [name for name in names if name not in result]
+        if missing:
+            self.fetch(db, missing, result)
+            created = [name for name in missing if name not in result]
+            if created:
+                db.execute(self.name_column.table.insert(), [self.new_row(name, now) for name in created])
+                self.fetch(db, created, result)
+        return result
+
+    def fetch(self, db, names, result):
+        """Ids of the existing rows, without caching them."""
+        for chunk in chunks(names):
+            # Databases created by older versions may have duplicate devices, we always take the first one
+            query = db.query(self.name_column, sqlalchemy.func.min(self.id_column))\
+                .filter(self.name_column.in_(chunk)).group_by(self.name_column)
+            result.update(query)
+
+    def update(self, ids):
+        with self.lock:
+            for name, row_id in ids.iteritems():
+                self.ids.pop(name, None)
+                self.ids[name] = row_id
+            while len(self.ids) > self.size:
+                self.ids.popitem(last=False)
+
+device_idents = NameIds(
+    Device.ident, Device.id, args.device_cache_size,
+    lambda ident, now: {"ident": ident, "date_created": now, "date_updated": now}
+)
 
-        if not ident:
-            self.set_status(400)
-            self.write(
-                {
-                    "status": "error",
-                    "message": "No identifier could be found",
-                    "possible identifiers": conf_possible_ident
-                }
+
+def _report_ids(db, reports):
+    """Fetches the ids of the stored reports matching (device_id, date, type) of some parsed reports."""
+    ids = {}
+    dates = [r['date'] for r in reports]
+    for device_ids in chunks(set(r['device_id'] for r in reports)):
+        query = db.query(DeviceReport.id, DeviceReport.device_id, DeviceReport.date, DeviceReport.type).filter(
+            DeviceReport.device_id.in_(device_ids),
+            DeviceReport.date >= min(dates),
+            DeviceReport.date <= max(dates)
+        )
+        for id, device_id, date, type in query:
+            ids[(device_id, date, type)] = id
+    return ids
+
+
+class BatchWriter(threading.Thread):
+    """Write-behind storage of the reports or of the events.
+
+    Items are queued by the request handlers and committed by batches (group commit) from this thread, so that the
+    IOLoop never waits for the disk.
+    """
+    def __init__(self, name, store, batch_size, linger, high_water):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.queue = Queue.Queue()
+        self.store = store
+        self.batch_size = batch_size
+        self.linger = linger
+        self.high_water = high_water
+
+    def full(self, nb=1):
+        return self.queue.qsize() + nb > self.high_water
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.linger
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except Queue.Empty:
+                    break
+            self.store_batch(batch)
+            session.remove()
+
+    def store_batch(self, batch):
+        # This thread has its own scoped session
+        try:
+            self.store(batch)
+        except Exception:
+            app_log.exception("%s could not store a batch of %d items, storing them one by one", self.name, len(batch))
+            # A single faulty item shouldn't make us lose the whole batch
+            for item in batch:
+                try:
+                    self.store([item])
+                except Exception:
+                    app_log.exception("%s could not store the item of %s at %s", self.name, item['ident'], item['date'])
+
+report_writer = None
+
+
+class PeriodicThread(threading.Thread):
+    """Runs a job periodically from its own thread, so that the IOLoop never waits for its statements.
+
+    The job releases its scoped session when it's done.
+    """
+    def __init__(self, name, job, period):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.job = job
+        self.period = period
+
+    def run(self):
+        while True:
+            time.sleep(self.period)
+            self.job()
+
+
+class FeedSubscriber(object):
+    """Filters of a client of the live feed, the handler receives the matching events."""
+    # Events that are not sent yet to a client before it's considered too slow and disconnected
+    MAX_PENDING = 100
+
+    def __init__(self, handler, types, device_id, group_ids, properties):
+        self.handler = handler
+        self.types = types
+        self.device_id = device_id
+        self.group_ids = group_ids
+        self.properties = properties
+        self.pending = 0
+
+    def matches(self, report):
+        if self.types and report['type'] not in self.types:
+            return False
+        if self.device_id is not None and report['device_id'] != self.device_id:
+            return False
+        if self.group_ids is not None and report['group_id'] not in self.group_ids:
+            return False
+        for name, values in self.properties.iteritems():
+            if name not in report['data'] or tornado.escape.json_encode(report['data'][name]) not in values:
+                return False
+        return True
+
+    def send(self, event):
+        if self.pending >= self.MAX_PENDING:
+            self.handler.finish()
+            return
+        self.pending += 1
+        self.handler.write(event)
+        self.handler.flush(callback=self.sent)
+
+    def sent(self):
+        self.pending -= 1
+
+
+class ReportFeed(object):
+    """Live feed of the stored reports.
+
+    Subscribers are indexed by their most selective filter (device, group, type), so that a report is only checked
+    against the subscribers that may want it. Each report is serialized once, whatever the number of subscribers.
+    Everything runs on the IOLoop, stores from other threads go through add_callback.
+    """
+    def __init__(self):
+        self.by_device = collections.defaultdict(set)
+        self.by_group = collections.defaultdict(set)
+        self.by_type = collections.defaultdict(set)
+        self.others = set()
+        self.nb_subscribers = 0
+        self.ioloop = None
+
+    def indexes(self, subscriber):
+        """Index sets the subscriber is in."""
+        if subscriber.device_id is not None:
+            return [self.by_device[subscriber.device_id]]
+        if subscriber.group_ids is not None:
+            return [self.by_group[group_id] for group_id in subscriber.group_ids]
+        if subscriber.types:
+            return [self.by_type[type] for type in subscriber.types]
+        return [self.others]
+
+    def subscribe(self, subscriber):
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        for index in self.indexes(subscriber):
+            index.add(subscriber)
+        self.nb_subscribers += 1
+
+    def unsubscribe(self, subscriber):
+        for index in self.indexes(subscriber):
+            index.discard(subscriber)
+        self.nb_subscribers -= 1
+        # Empty sets would accumulate with the devices that were watched once
+        for index in (self.by_device, self.by_group, self.by_type):
+            for key in [key for key, subscribers in index.iteritems() if not subscribers]:
+                del index[key]
+
+    def publish_threadsafe(self, reports):
+        # Reading the count without the IOLoop is fine, a subscriber may only miss what was stored as it connected
+        if reports and self.nb_subscribers:
+            self.ioloop.add_callback(self.publish, reports)
+
+    def publish(self, reports):
+        for report in reports:
+            candidates = self.others.union(
+                self.by_device.get(report['device_id'], ()),
+                self.by_group.get(report['group_id'], ()),
+                self.by_type.get(report['type'], ())
             )
+            event = None
+            for subscriber in candidates:
+                if subscriber.matches(report):
+                    if event is None:
+                        event = "id: {id}\ndata: {data}\n\n".format(id=report['id'], data=json.dumps({
+                            "id": report['id'],
+                            "date": str(report['date']),
+                            "device_id": report['device_id'],
+                            "device": report['ident'],
+                            "group_id": report['group_id'],
+                            "type": report['type'],
+                            "data": report['data'],
+                        }))
+                    subscriber.send(event)
+        metrics.inc("edms_feed_reports_total", len(reports))
+
+    def keepalive(self):
+        """Detects the clients that are gone, SSE comments are ignored by the others."""
+        for index in [self.others] + self.by_device.values() + self.by_group.values() + self.by_type.values():
+            for subscriber in list(index):
+                subscriber.send(":\n\n")
+
+report_feed = ReportFeed()
+
+
+def write_busy(handler, nb=1, metric="edms_reports_total"):
+    """Reports or events are refused when their writer thread is late."""
+    metrics.inc(metric, nb, outcome="busy")
+    handler.set_status(503)
+    handler.set_header("Retry-After", "1")
+    handler.write({"status": "error", "message": "Server busy"})
+
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+# Largest decompressed body, compressed bodies are limited by the max_body_size of the server
+MAX_DECOMPRESSED_SIZE = 100 * 1024 * 1024
+
+
+def request_body(request):
+    """Body of a request sent by a device, decompressed according to its Content-Encoding (gzip or deflate)."""
+    encoding = request.headers.get("Content-Encoding", "identity").strip().lower()
+    if encoding == "identity":
+        return request.body
+    if encoding in ("gzip", "x-gzip"):
+        wbits = 16 + zlib.MAX_WBITS
+    elif encoding == "deflate":
+        # zlib stream as the RFC says, or raw deflate as some clients send it
+        wbits = zlib.MAX_WBITS if request.body[:1] == "\x78" else -zlib.MAX_WBITS
+    else:
+        raise ReportError("Unsupported Content-Encoding", {"encoding": encoding}, 415)
+    decompressor = zlib.decompressobj(wbits)
+    try:
+        body = decompressor.decompress(request.body, MAX_DECOMPRESSED_SIZE)
+    except zlib.error:
+        raise ReportError("Invalid compressed body")
+    if decompressor.unconsumed_tail:
+        raise ReportError("Decompressed body too large", status=413)
+    return body
+
+
+def request_decode(request, lines=False):
+    """Decoded body of a request sent by a device, as JSON or as MessagePack according to its Content-Type.
+
+    With lines, NDJSON (one JSON document per line) is also accepted and gives a list. Raises a ValueError when the
+    body is not valid JSON.
+    """
+    body = request_body(request)
+    content_type = request.headers.get("Content-Type", "").split(";")[0].strip().lower()
+    if content_type in MSGPACK_TYPES:
+        if not msgpack:
+            raise ReportError("MessagePack is not supported by this server", status=415)
+        try:
+            return msgpack.unpackb(body, raw=False)
+        except Exception:
+            raise ReportError("Invalid MessagePack")
+    # Devices send their JSON with any content type (curl uses application/x-www-form-urlencoded)
+    try:
+        return json.loads(body)
+    except ValueError:
+        if not lines:
+            raise
+        # The decoding of NDJSON stops at the end of the first line
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+class DeviceReportPage(SessionHandler):
+    def post(self):
+        try:
+            report = report_parse(request_decode(self.request))
+        except ValueError:
+            report = None
+            error = ReportError("Invalid JSON")
+        except ReportError as e:
+            report = None
+            error = e
+
+        if not report:
+            error.count()
+            self.set_status(error.status)
+            self.write(error.to_dict())
             return
 
-        if type:
-            del data['type']
-        else:
-            type = '_'
+        if report_writer:
+            if report_writer.full():
+                write_busy(self)
+                return
+            report_writer.put(report)
+            metrics.inc("edms_reports_total", outcome="queued")
+            self.set_status(202)
+            self.write({"status": "queued"})
+            return
 
-        device = get_or_create_device(ident)
-        if not device.date_seen or date > device.date_seen:
-            device.date_seen = date
+        self.write(store_reports([report])[0])
 
-        # We will try to attach this device to a group of devices
-        conf_possible_group = conf_get("report_possible_device_group_field", "device_group")
-        group_ident = data.get(conf_possible_group)
-        if group_ident:
-            group = session.query(DeviceGroup).filter(DeviceGroup.ident == group_ident).first()
+    def get(self):
+        self.render("error.html", title=_("Error"), error=_("This page can only be used in POST mode"))
 
-            if not group and bool(conf_get("device_group_auto_create", "false")):
-                group = DeviceGroup(name=group_ident, ident=group_ident)
-                session.add(group)
 
-            if group:
-                device.group_id = group.id
+def bulk_decode(request):
+    """Items of a JSON or MessagePack array, of NDJSON (one item per line) or a single object.
 
-        session.commit()
+    Also tells whether a single object was sent.
+    """
+    try:
+        items = request_decode(request, lines=True)
+    except ValueError:
+        raise ReportError("Invalid JSON")
+    if not isinstance(items, list):
+        return [items], True
+    return items, False
 
-        changes = False
 
-        if bool(conf_get("report_json_flatten", "true")):
-            data = json_flatten(data)
+class DeviceReportsBulkPage(SessionHandler):
+    """Many reports at once, as a JSON or MessagePack array or as NDJSON (one report per line)."""
+    def post(self):
+        try:
+            items = bulk_decode(self.request)[0]
+        except ReportError as e:
+            e.count()
+            self.set_status(e.status)
+            self.write(e.to_dict())
+            return
 
-        report = DeviceReport()
-        report.device_id = device.id
-        report.date = date
-        report.type = type
+        statuses = [None] * len(items)
+        reports = []
+        positions = []
+        for i, item in enumerate(items):
+            try:
+                reports.append(report_parse(item))
+                positions.append(i)
+            except ReportError as e:
+                e.count()
+                statuses[i] = e.to_dict()
+
+        if reports and report_writer:
+            if report_writer.full(len(reports)):
+                write_busy(self, len(reports))
+                return
+            for i, report in zip(positions, reports):
+                report_writer.put(report)
+                statuses[i] = {"status": "queued"}
+            metrics.inc("edms_reports_total", len(reports), outcome="queued")
+            self.set_status(202)
+        elif reports:
+            for i, status in zip(positions, store_reports(reports)):
+                statuses[i] = status
+
+        self.write({"status": "ok", "reports": statuses})
+
+
+class DeviceConfigWaiters(object):
+    """Devices waiting for their configuration, by ident.
+
+    Waiting costs a future and a timeout on the IOLoop, nothing is read from the database until a value is set for the
+    device. Values set by other processes are found by a single periodic query (see check).
+    """
+    def __init__(self):
+        self.waiters = {}
+        self.checked = datetime.utcnow()
+
+    @tornado.gen.coroutine
+    def wait(self, ident, timeout):
+        future = tornado.concurrent.Future()
+        waiters = self.waiters.setdefault(ident, set())
+        waiters.add(future)
+        try:
+            yield tornado.gen.with_timeout(timedelta(seconds=timeout), future)
+        except tornado.gen.TimeoutError:
+            pass
+        finally:
+            waiters.discard(future)
+            if not waiters and self.waiters.get(ident) is waiters:
+                del self.waiters[ident]
+
+    def notify(self, idents):
+        for ident in idents:
+            for future in self.waiters.get(ident, ()):
+                if not future.done():
+                    future.set_result(None)
+
+    def check(self):
+        """Wakes the devices whose values were set by other processes."""
+        # A value set just before we last checked may have been committed after, waking a device twice is harmless
+        since = self.checked - timedelta(seconds=5)
+        self.checked = datetime.utcnow()
+        if not self.waiters:
+            return
+        try:
+            self.notify([ident for ident, in session.query(Device.ident).join(
+                DeviceConfig, DeviceConfig.device_id == Device.id
+            ).filter(DeviceConfig.date_set >= since)])
+        finally:
+            session.remove()
+
+device_config_waiters = DeviceConfigWaiters()
+
+
+def device_config_pending(db, ident, since):
+    """Values set for a device that it didn't acknowledge, and the date of the last one."""
+    query = db.query(DeviceConfig.name, DeviceConfig.value_set, DeviceConfig.date_set).join(
+        Device, Device.id == DeviceConfig.device_id
+    ).filter(
+        Device.ident == ident,
+        sqlalchemy.or_(DeviceConfig.value_ack.is_(None), DeviceConfig.value_ack != DeviceConfig.value_set)
+    )
+    if since:
+        query = query.filter(DeviceConfig.date_set > since)
+    rows = query.all()
+    return dict((name, value) for name, value, date in rows), max([date for name, value, date in rows] or [since])
+
+
+class DeviceConfigPoll(SessionHandler):
+    """Configuration values that a device has to apply.
+
+    The device is identified like in its reports (hostname=xps for example). The request waits until a value is set
+    or "timeout" seconds. Values set after "since" (the "version" of the previous response) are returned until the
+    device acknowledges them on /device-config/ack.
+    """
+    @tornado.gen.coroutine
+    def get(self):
+        ident = device_ident(dict((name, values[-1]) for name, values in self.request.arguments.iteritems()))
+        if not ident:
+            raise tornado.web.HTTPError(400, "No identifier could be found")
+        since = self.get_argument("since", None)
+        since = parse_date(since) if since else None
+        try:
+            timeout = float(self.get_argument("timeout", args.config_poll_timeout))
+        except ValueError:
+            timeout = None
+        if timeout is None or math.isnan(timeout):
+            raise tornado.web.HTTPError(400, "Incorrect timeout")
+        timeout = max(0, min(timeout, args.config_poll_timeout))
+        deadline = time.time() + timeout
+
+        while True:
+            # Other requests use the scoped session while this one waits
+            db = Session()
+            try:
+                config, version = device_config_pending(db, ident, since)
+            finally:
+                db.close()
+            if config or time.time() >= deadline:
+                break
+            yield device_config_waiters.wait(ident, deadline - time.time())
 
-        previous = session.query(DeviceReport).filter(
-            DeviceReport.device_id == report.device_id,
-            DeviceReport.type == report.type,
-            DeviceReport.date == report.date
-        ).first()
+        self.write({"config": config, "version": str(version) if version else None})
 
-        if not previous:
-            changes = True
-            session.add(report)
-            session.commit()
-        else:
-            report = previous
 
-        # We update these report properties in the device properties
+class DeviceConfigAck(SessionHandler):
+    """A device acknowledges the values it applied: {"hostname": "xps", "config": {"name": "value"}}."""
+    def post(self):
         try:
-            for name, value in data.iteritems():
-                value = tornado.escape.json_encode(value)
-                # We check if the value isn't already stored (not doing so
-                previous = session.query(DevicePropertyHistory).filter(
-                    DevicePropertyHistory.device_id == device.id,
-                    DevicePropertyHistory.name == name,
-                    DevicePropertyHistory.report_id == report.id).first()
-                if not previous:  # If not, we store it
-                    changes = True
-                    session.merge(
-                        DevicePropertyHistory(
-                            device_id=device.id,
-                            name=name,
-                            date=date,
-                            report_id=report.id,
-                            value=value
-                        )
-                    )
-
-                # We only take the last value as the current one
-                last = session.query(DevicePropertyHistory).filter(
-                    DevicePropertyHistory.device_id == device.id,
-                    DevicePropertyHistory.name == name,
-                    DevicePropertyHistory.date == date).order_by(DevicePropertyHistory.date.desc()).first()
-                session.merge(
-                    DeviceProperty(
-                        device_id=last.device_id,
-                        name=last.name,
-                        value=last.value
-                    )
-                )
-        except IntegrityError:
-            session.rollback()
+            data = tornado.escape.json_decode(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Invalid JSON")
+        if not isinstance(data, dict) or not isinstance(data.get("config"), dict):
+            raise tornado.web.HTTPError(400, "No config")
+        ident = device_ident(data)
+        if not ident:
+            raise tornado.web.HTTPError(400, "No identifier could be found")
+        device_id = session.query(Device.id).filter(Device.ident == ident).scalar()
+        if not device_id:
+            raise tornado.web.HTTPError(404, "Unknown device")
+
+        now = datetime.utcnow()
+        begin_write(session)
+        for name, value in data["config"].iteritems():
+            session.query(DeviceConfig).filter(
+                DeviceConfig.device_id == device_id,
+                DeviceConfig.name == name
+            ).update({DeviceConfig.value_ack: value, DeviceConfig.date_ack: now}, synchronize_session=False)
+        session.commit()
+        self.write({"status": "ok"})
 
-        if changes and date > device.date_updated:
-            device.date_updated = date
 
+class DeviceConfigApi(SecureHandler):
+    """Configuration values of a device, admins set them with POST name=...&value=..."""
+    def get(self, device_id):
+        if not self.check_access_right():
+            return
+        query = session.query(DeviceConfig).filter(DeviceConfig.device_id == int(device_id))
+        self.write({
+            "config": [
+                {
+                    "name": config.name,
+                    "value_set": config.value_set,
+                    "date_set": str(config.date_set) if config.date_set else None,
+                    "value_ack": config.value_ack,
+                    "date_ack": str(config.date_ack) if config.date_ack else None
+                } for config in query.order_by(DeviceConfig.name)
+            ]
+        })
+
+    def post(self, device_id):
+        if not self.check_admin_right():
+            return
+        device = session.query(Device).filter(Device.id == int(device_id)).first()
+        if not device:
+            raise tornado.web.HTTPError(404)
+        name = self.get_argument("name")
+        begin_write(session)
+        config = session.query(DeviceConfig).filter(
+            DeviceConfig.device_id == device.id,
+            DeviceConfig.name == name
+        ).first()
+        if not config:
+            config = DeviceConfig(device_id=device.id, name=name)
+            session.add(config)
+        config.value_set = self.get_argument("value")
+        config.date_set = datetime.utcnow()
         session.commit()
+        device_config_waiters.notify([device.ident])
+        self.write({"status": "ok"})
 
-        if changes:
-            self.write({"status": "ok"})
+
+def event_parse(data):
+    """Extracts the ident, date and type of a decoded event, the other fields are kept as JSON."""
+    if not isinstance(data, dict):
+        raise ReportError("Event must be a JSON object")
+    ident = device_ident(data)
+    if not ident:
+        raise ReportError("No identifier could be found", {
+            "possible identifiers": conf_get_list("report_possible_ident_fields", "ident,hostname")
+        })
+    date = data.pop('date', None)
+    if not date:
+        raise ReportError("No date specified")
+    try:
+        # Events don't always have microseconds
+        date = report_date(date, microseconds=False)
+    except (ValueError, TypeError):
+        raise ReportError("Incorrect date format")
+    return {
+        "ident": ident,
+        "date": date,
+        "type": data.pop('event_type', None) or '_',
+        "data": json.dumps(data)
+    }
+
+
+event_types = NameIds(DeviceEventType.name, DeviceEventType.id, 10000, lambda name, now: {"name": name})
+
+
+def store_events(events, db=None):
+    """Appends some parsed events to the tables of their months, in a single transaction."""
+    if db is None:
+        db = session
+    begin_write(db)
+    try:
+        now = datetime.utcnow()
+        device_ids = device_idents.get_or_create(db, set(e['ident'] for e in events), now)
+        type_ids = event_types.get_or_create(db, set(e['type'] for e in events), now)
+        # Devices that never sent a report are seen at their last event
+        seen = {}
+        for event in events:
+            device_id = device_ids[event['ident']]
+            seen[device_id] = max(seen.get(device_id, event['date']), event['date'])
+        db.execute(
+            Device.__table__.update()
+            .where(Device.id == sqlalchemy.bindparam("b_id"))
+            .where(Device.date_seen.is_(None))
+            .values(date_seen=sqlalchemy.bindparam("b_date")),
+            [{"b_id": device_id, "b_date": date} for device_id, date in seen.iteritems()]
+        )
+        months = collections.defaultdict(list)
+        for event in events:
+            months[MonthPartitions.month(event['date'])].append({
+                "device_id": device_ids[event['ident']],
+                "type_id": type_ids[event['type']],
+                "date": event['date'],
+                "data": event['data']
+            })
+        for month, rows in months.iteritems():
+            event_partitions.insert(db, month, rows)
+        db.commit()
+    except:
+        db.rollback()
+        event_partitions.rollback()
+        raise
+    device_idents.update(device_ids)
+    event_types.update(type_ids)
+    metrics.inc("edms_events_total", len(events), outcome="ok")
+
+
+event_writer = None
+
+
+class DeviceEventPage(SessionHandler):
+    """Events of devices, one JSON object or many of them (JSON array or NDJSON).
+
+    Events are only appended, they are stored by the events writer thread.
+    """
+    def post(self):
+        try:
+            items, single = bulk_decode(self.request)
+        except ReportError as e:
+            e.count("edms_events_total")
+            self.set_status(e.status)
+            self.write(e.to_dict())
+            return
+
+        statuses = []
+        events = []
+        for item in items:
+            try:
+                events.append(event_parse(item))
+                statuses.append({"status": "queued"})
+            except ReportError as e:
+                e.count("edms_events_total")
+                statuses.append(e.to_dict())
+
+        if events and event_writer:
+            if event_writer.full(len(events)):
+                write_busy(self, len(events), "edms_events_total")
+                return
+            for event in events:
+                event_writer.put(event)
+            self.set_status(202)
+        elif events:
+            store_events(events)
+            statuses = [{"status": "ok"} if status["status"] == "queued" else status for status in statuses]
+
+        if single:
+            if statuses[0]["status"] == "error":
+                self.set_status(400)
+            self.write(statuses[0])
         else:
-            self.write({"status": "ok", "already_sent": True})
+            self.write({"status": "ok", "events": statuses})
+
 
+class DeviceEventsApi(SecureHandler):
+    """Most recent events, of a device (device_id) and/or of a type, between from and to."""
     def get(self):
-        self.render("error.html", title=_("Error"), error=_("This page can only be used in POST mode"))
+        if not self.check_access_right():
+            return
+        nb = min(parse_int(self.get_argument("nb", 100), "nb"), 1000)
+        device_id = self.get_argument("device_id", None)
+        device_id = parse_int(device_id, "device_id") if device_id else None
+        type = self.get_argument("type", None)
+        date_from = self.get_argument("from", None)
+        date_from = parse_date(date_from) if date_from else None
+        date_to = self.get_argument("to", None)
+        date_to = parse_date(date_to) if date_to else None
+
+        type_id = None
+        if type:
+            type_id = session.query(DeviceEventType.id).filter(DeviceEventType.name == type).scalar()
+            if type_id is None:
+                self.write({"events": []})
+                return
+
+        events = []
+        for table in event_partitions.covering(session, date_from, date_to):
+            query = sqlalchemy.select([table.c.device_id, table.c.type_id, table.c.date, table.c.data])
+            if device_id is not None:
+                query = query.where(table.c.device_id == device_id)
+            if type_id:
+                query = query.where(table.c.type_id == type_id)
+            if date_from:
+                query = query.where(table.c.date >= date_from)
+            if date_to:
+                query = query.where(table.c.date < date_to)
+            events.extend(session.execute(query.order_by(table.c.date.desc()).limit(nb - len(events))))
+            if len(events) >= nb:
+                break
+
+        types = dict(session.query(DeviceEventType.id, DeviceEventType.name)
+                     .filter(DeviceEventType.id.in_(set(event.type_id for event in events))))
+        self.write({
+            "events": [
+                {
+                    "device_id": event.device_id,
+                    "type": types.get(event.type_id),
+                    "date": str(event.date),
+                    "data": json.loads(event.data)
+                } for event in events
+            ]
+        })
 
 
 class ConfigPage(SecureHandler):
     def get(self, name=None):
-        self.check_access_right()
+        if not self.check_access_right():
+            return
         if name == u"new":
             conf = Config()
             conf.name = ""
@@ -436,6 +2556,152 @@ class ConfigPage(SecureHandler):
         self.render("config.html", title=_("Config"), parameters=parameters, param=None)
 
 
+class PostingList(object):
+    """Sorted ids of the rows having one of the values of a property, in the (name, value, id) index of some tables.
+
+    The list is read backwards, one index seek per table and value at a time, it's never loaded in memory. filters
+    gives the other conditions on the rows of a table.
+    """
+    def __init__(self, tables, id_name, name, values, filters=lambda table: ()):
+        self.tables = tables
+        self.id_name = id_name
+        self.name = name
+        self.values = values
+        self.filters = filters
+
+    def seek(self, upper=None):
+        """Greatest id lower or equal to upper."""
+        found = None
+        for table in self.tables:
+            id_column = table.c[self.id_name]
+            for value in self.values:
+                query = session.query(id_column).filter(table.c.name == self.name, table.c.value == value,
+                                                        *self.filters(table))
+                if upper is not None:
+                    query = query.filter(id_column <= upper)
+                id = query.order_by(id_column.desc()).limit(1).scalar()
+                if id is not None and (found is None or id > found):
+                    found = id
+        return found
+
+
+def intersect(postings, upper=None):
+    """Ids present in all the posting lists, from the greatest one (leapfrog intersection)."""
+    candidate = upper
+    while True:
+        agreed = 0
+        i = 0
+        while agreed < len(postings):
+            found = postings[i % len(postings)].seek(candidate)
+            if found is None:
+                return
+            if found == candidate:
+                agreed += 1
+            else:
+                candidate = found
+                agreed = 1
+            i += 1
+        yield candidate
+        candidate -= 1
+
+
+def report_postings(db, arguments, date_from=None, date_to=None, device_id=None):
+    """Posting lists of the reports in the history tables of the dates, the history rows have the date and the device
+    of their report."""
+    def filters(table):
+        conditions = []
+        if date_from:
+            conditions.append(table.c.date >= date_from)
+        if date_to:
+            conditions.append(table.c.date < date_to)
+        if device_id is not None:
+            conditions.append(table.c.device_id == device_id)
+        return conditions
+    tables = history_tables(db, date_from, date_to)
+    return [PostingList(tables, "report_id", k, v, filters) for k, v in arguments.items()]
+
+
+def device_postings(arguments):
+    return [PostingList([DeviceProperty.__table__], "device_id", k, v) for k, v in arguments.items()]
+
+
+def report_range(arguments):
+    """Dates of the from and to arguments, None when they are missing."""
+    date_from = arguments.get('from')
+    date_to = arguments.get('to')
+    return parse_date(date_from[-1]) if date_from else None, parse_date(date_to[-1]) if date_to else None
+
+
+def report_filter(query, arguments):
+    """Filters reports by the type, device_id, group_id (including its subgroups), from and to arguments.
+
+    The other arguments are property filters, they are returned.
+    """
+    arguments = dict(arguments)
+
+    # Type
+    type = arguments.pop('type', None)
+    if type:
+        query = query.filter(DeviceReport.type.in_(type))
+
+    # Device id
+    device_id = arguments.pop('device_id', None)
+    if device_id:
+        query = query.filter(DeviceReport.device_id == parse_int(device_id[-1], "device_id"))
+
+    # Devices of the group and of its subgroups
+    group_id = arguments.pop('group_id', None)
+    if group_id:
+        query = query.filter(DeviceReport.device_id.in_(
+            sqlalchemy.select([Device.id]).where(Device.group_id.in_(group_subtree(parse_int(group_id[-1], "group_id"))))
+        ))
+
+    # Dates
+    date_from, date_to = report_range(arguments)
+    arguments.pop('from', None)
+    arguments.pop('to', None)
+    if date_from:
+        query = query.filter(DeviceReport.date >= date_from)
+    if date_to:
+        query = query.filter(DeviceReport.date < date_to)
+
+    return query, arguments
+
+
+def filter_property_stored(query, k, v, date_from=None, date_to=None):
+    """Reports having one of these values, through the (name, value, report_id) index.
+
+    The history is only read in the range of the reports dates.
+    """
+    return query.filter(sqlalchemy.or_(*[
+        sqlalchemy.exists().where(sqlalchemy.and_(
+            history.c.report_id == DeviceReport.id,
+            history.c.name == k,
+            history.c.value.in_(v)
+        )).correlate(DeviceReport.__table__)
+        for history in history_tables(query.session, date_from, date_to)
+    ]))
+
+
+def filter_property_in_effect(query, k, v, date_to=None):
+    """Only the changes of the properties are stored, the value in effect is the last one before the report.
+
+    It's the most recent of the last values before the report of each table.
+    """
+    lasts = []
+    for history in history_tables(query.session, None, date_to):
+        last = sqlalchemy.select([history.c.date, history.c.value]).where(sqlalchemy.and_(
+            history.c.device_id == DeviceReport.device_id,
+            history.c.name == k,
+            history.c.date <= DeviceReport.date
+        )).order_by(history.c.date.desc()).limit(1).correlate(DeviceReport.__table__).alias()
+        lasts.append(sqlalchemy.select([last.c.date, last.c.value]))
+    last = sqlalchemy.union_all(*lasts).alias() if len(lasts) > 1 else lasts[0].alias()
+    value = sqlalchemy.select([last.c.value]).order_by(last.c.date.desc()).limit(1)\
+        .correlate(DeviceReport.__table__).as_scalar()
+    return query.filter(value.in_(v))
+
+
 class LastReports(SecureHandler):
 
     def query(self, nb=40):
@@ -445,31 +2711,26 @@ class LastReports(SecureHandler):
         # Paging
         paging_to = self.request.arguments.get('paging_to')
         if paging_to:
-            query = query.filter(DeviceReport.id <= int(paging_to[0]))
+            paging_to = parse_int(paging_to[0], "paging_to")
+            query = query.filter(DeviceReport.id <= paging_to)
             del self.request.arguments['paging_to']
 
-        # Type
-        type = self.request.arguments.get('type')
-        if type:
-            query = query.filter(DeviceReport.type.in_(type))
-            del self.request.arguments['type']
+        query, properties = report_filter(query, self.request.arguments)
+        date_from, date_to = report_range(self.request.arguments)
 
-        # Device id
-        device_id = self.get_argument("device_id", None)
-        if device_id:
-            query = query.filter(DeviceReport.device_id == int(device_id))
-            del self.request.arguments['device_id']
-
-        for k, v in self.request.arguments.items():
-            query = query\
-                .join(DevicePropertyHistory, aliased=True)\
-                .filter(
-                    DevicePropertyHistory.name == k,
-                    DevicePropertyHistory.value.in_(v)
-                )
+        if properties and not conf_get_bool("report_history_changes_only", "false"):
+            # Reports having all the property values, through their posting lists
+            device_id = self.request.arguments.get('device_id')
+            postings = report_postings(
+                session, properties, date_from, date_to, int(device_id[-1]) if device_id else None
+            )
+            query = self.intersect_properties(query, postings, paging_to, nb)
+        else:
+            for k, v in properties.items():
+                query = filter_property_in_effect(query, k, v, date_to)
 
-        query = query.limit(nb+1)
-        query = query.all()
+            query = query.limit(nb+1)
+            query = query.all()
 
         link_previous = None
         link_next = None
@@ -487,35 +2748,789 @@ class LastReports(SecureHandler):
 
         return query, link_previous, link_next
 
+    def intersect_properties(self, query, postings, paging_to, nb):
+        """Reports of the query in the intersection of the posting lists.
+
+        They are ordered by id, the order they were received, and not by date. The posting lists already have the dates
+        and the device of the query, its other filters are applied to a chunk of ids at a time.
+        """
+        reports = []
+        ids = intersect(postings, paging_to)
+        for chunk in chunks(ids, nb + 1):
+            found = dict((report.id, report) for report in query.filter(DeviceReport.id.in_(chunk)))
+            reports.extend(found[id] for id in chunk if id in found)
+            if len(reports) > nb:
+                break
+        return reports[:nb+1]
+
     def get(self):
-        self.check_access_right()
+        if not self.check_access_right():
+            return
+        paging = 'paging_to' in self.request.arguments
         reports, link_previous, link_next = self.query()
 
         self.render(
             "last_reports.html",
             title=_("Last reports"),
             reports=reports,
-            paging_previous=link_previous, paging_next=link_next
+            paging_previous=link_previous, paging_next=link_next,
+            # Only the first page can be updated live, with the same filters
+            feed=None if paging else "/last-reports/feed?" + urllib.urlencode(self.request.arguments, doseq=True)
         )
 
 
-class ShowReport(SecureHandler):
+class ReportFeedHandler(SecureHandler):
+    """Server-Sent Events stream of the new reports.
+
+    It takes the type, device_id, group_id (including its subgroups) and property filters of the last reports page.
+    """
+    @tornado.web.asynchronous
+    def get(self):
+        if not self.check_access_right():
+            return
+        arguments = dict(self.request.arguments)
+        # New reports are sent whatever their date
+        arguments.pop('from', None)
+        arguments.pop('to', None)
+        types = set(arguments.pop('type', []))
+        device_id = arguments.pop('device_id', None)
+        group_id = arguments.pop('group_id', None)
+        group_ids = None
+        if group_id:
+            group_ids = set(row[0] for row in session.execute(group_subtree(parse_int(group_id[-1], "group_id"))))
+        self.subscriber = FeedSubscriber(
+            self,
+            types,
+            parse_int(device_id[-1], "device_id") if device_id else None,
+            group_ids,
+            dict((name, set(values)) for name, values in arguments.iteritems())
+        )
+        # The connection stays open, it must not keep a database connection
+        session.remove()
+
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        self.write(":\n\n")
+        self.flush()
+        report_feed.subscribe(self.subscriber)
+
+    def on_connection_close(self):
+        self.on_finish()
+
+    def on_finish(self):
+        SecureHandler.on_finish(self)
+        subscriber = getattr(self, "subscriber", None)
+        if subscriber:
+            self.subscriber = None
+            report_feed.unsubscribe(subscriber)
+
+
+stream_slots = threading.BoundedSemaphore(args.max_streams)
+
+
+class StreamHandler(SecureHandler):
+    """Handler streaming its response a chunk at a time.
+
+    It uses its own session since other requests run while it waits for the client. This session holds a connection
+    of the pool and a read transaction until the end of the response, which keeps the WAL from being checkpointed, so
+    only --max-streams responses are streamed at once.
+    """
+    def stream_session(self):
+        """The session of the response, None when too many responses are streamed (503 is answered)."""
+        if not stream_slots.acquire(False):
+            metrics.inc("edms_streams_total", outcome="busy")
+            self.set_status(503)
+            self.set_header("Retry-After", "1")
+            self.write({"status": "error", "message": "Server busy"})
+            return None
+        metrics.inc("edms_streams_total", outcome="ok")
+        return Session()
+
+    def stream_done(self, db):
+        db.close()
+        stream_slots.release()
+
+
+class ExportHandler(StreamHandler):
+    """Streams rows as NDJSON or CSV, gzipped on demand.
+
+    It takes the same filters as the last reports page, plus "format" (ndjson or csv) and "gzip". Subclasses give the
+    query of the rows.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    CHUNK = 1000
+    COLUMNS = ()
+    NAME = None
+
+    @tornado.gen.coroutine
+    def get(self):
+        if not self.check_access_right():
+            return
+        arguments = dict(self.request.arguments)
+        format = arguments.pop("format", ["ndjson"])[-1]
+        if format not in ("ndjson", "csv"):
+            raise tornado.web.HTTPError(400, "Unknown format: %s", format)
+        db = self.stream_session()
+        if db is None:
+            return
+        compressor = None
+        filename = "{name}.{format}".format(name=self.NAME, format=format)
+        if arguments.pop("gzip", ["0"])[-1] in ("1", "true"):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31: gzip header
+            self.set_header("Content-Encoding", "gzip")
+        self.set_header("Content-Type", "text/csv" if format == "csv" else "application/x-ndjson")
+        self.set_header("Content-Disposition", 'attachment; filename="{name}"'.format(name=filename))
+        try:
+            date_from, date_to = report_range(arguments)
+            query, properties = report_filter(self.query(db, date_from, date_to), arguments)
+            changes_only = conf_get_bool("report_history_changes_only", "false")
+            for k, v in properties.items():
+                if changes_only:
+                    query = filter_property_in_effect(query, k, v, date_to)
+                else:
+                    query = filter_property_stored(query, k, v, date_from, date_to)
+            result = db.execute(query.statement.execution_options(stream_results=True))
+            if format == "csv":
+                self.write_chunk(compressor, self.csv([self.COLUMNS]))
+            while True:
+                rows = result.fetchmany(self.CHUNK)
+                if not rows:
+                    break
+                if format == "csv":
+                    self.write_chunk(compressor, self.csv(self.csv_row(row) for row in rows))
+                else:
+                    self.write_chunk(compressor, "".join(json.dumps(self.json_row(row)) + "\n" for row in rows))
+                yield self.flush()
+            if compressor:
+                self.write(compressor.flush())
+        finally:
+            self.stream_done(db)
+
+    def write_chunk(self, compressor, data):
+        if compressor:
+            data = compressor.compress(data)
+        if data:
+            self.write(data)
+
+    def csv(self, rows):
+        output = StringIO.StringIO()
+        writer = csv.writer(output)
+        for row in rows:
+            writer.writerow([unicode(v).encode("utf-8") if v is not None else "" for v in row])
+        return output.getvalue()
+
+    @abc.abstractmethod
+    def query(self, db, date_from, date_to):
+        """Query of the rows in the range of the dates, the filters of the request are added to it."""
+
+    def json_row(self, row):
+        return dict((column, str(row[column]) if isinstance(row[column], datetime) else row[column])
+                    for column in self.COLUMNS)
+
+    def csv_row(self, row):
+        return [row[column] for column in self.COLUMNS]
+
+
+class ExportReports(ExportHandler):
+    COLUMNS = ("id", "device_id", "ident", "date", "type")
+    NAME = "reports"
+
+    def query(self, db, date_from, date_to):
+        return db.query(DeviceReport.id, DeviceReport.device_id, Device.ident, DeviceReport.date, DeviceReport.type)\
+            .join(Device, Device.id == DeviceReport.device_id)\
+            .order_by(DeviceReport.id)
+
+
+class ExportProperties(ExportHandler):
+    """Properties history of the reports, when only the changes are stored these are the changes."""
+    COLUMNS = ("report_id", "device_id", "ident", "date", "name", "value")
+    NAME = "properties"
+
+    def query(self, db, date_from, date_to):
+        history = history_union(db, date_from, date_to)
+        return db.query(
+            history.c.report_id,
+            history.c.device_id,
+            Device.ident,
+            history.c.date,
+            history.c.name,
+            history.c.value
+        ).select_from(history).join(DeviceReport, DeviceReport.id == history.c.report_id)\
+            .join(Device, Device.id == history.c.device_id)\
+            .order_by(history.c.report_id)
+
+    def json_row(self, row):
+        data = ExportHandler.json_row(self, row)
+        data["value"] = json.loads(data["value"])
+        return data
+
+
+class ShowReport(SecureHandler, ConditionalMixin):
     def get(self, reportId):
-        self.check_access_right()
-        report = session.query(DeviceReport).filter(DeviceReport.id == reportId).first()
-        if report:
-            properties = session.query(DevicePropertyHistory).filter(
-                DevicePropertyHistory.device_id == report.device_id,
-                DevicePropertyHistory.date == report.date
-            ).all()
-            self.render("report.html", title=_("Report"), report=report, properties=properties)
+        if not self.check_access_right():
+            return
+        row = session.query(DeviceReport, Device).join(Device, Device.id == DeviceReport.device_id)\
+            .filter(DeviceReport.id == reportId).first()
+        if row:
+            report, device = row
+            changes_only = conf_get_bool("report_history_changes_only", "false")
+            cutoff = history_cutoff()
+            # Reports only change with the history of their device and the source of their properties
+            validator = (
+                report.id, device.ident, device.version, device.date_seen, changes_only,
+                bool(cutoff and report.date < cutoff)
+            )
+            if self.not_modified(validator, device.date_seen):
+                return
+            if changes_only:
+                properties = properties_at(session, report.device_id, report.date)
+            else:
+                history = history_union(session, report.date, report.date + timedelta(microseconds=1))
+                properties = session.query(history.c.name, history.c.value).filter(
+                    history.c.device_id == report.device_id,
+                    history.c.date == report.date
+                ).all()
+            if not properties and cutoff and report.date < cutoff:
+                # The history was deleted, we show the last values of the hour of the report
+                properties = session.query(DevicePropertyRollup.name, DevicePropertyRollup.last_value.label("value"))\
+                    .filter(
+                        DevicePropertyRollup.device_id == report.device_id,
+                        DevicePropertyRollup.period == ROLLUP_HOUR,
+                        DevicePropertyRollup.date == report.date.replace(minute=0, second=0, microsecond=0)
+                    ).order_by(DevicePropertyRollup.name).all()
+            self.render_cached("report.html", title=_("Report"), report=report, properties=properties)
         else:
             self.render("error.html", title=_("Error"), error=_("Report could not be found"))
 
 
+BUCKET_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_bucket(value):
+    """Bucket duration like "30s", "5m", "1h" or "1d", in seconds."""
+    match = re.match(r'^(\d+)([smhdw])$', value)
+    if not match or not int(match.group(1)):
+        raise tornado.web.HTTPError(400, "Incorrect bucket: %s", value)
+    return int(match.group(1)) * BUCKET_UNITS[match.group(2)]
+
+
+def is_number(value):
+    """Tells if a stored (JSON) property value is a number."""
+    try:
+        value = json.loads(value)
+    except ValueError:
+        return False
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+class PropertySeriesApi(StreamHandler):
+    """Values of a property over time, for some devices.
+
+    Numeric values are aggregated (min, max, avg, last) by buckets within SQLite, other values are returned as the
+    points where they changed. The part of the range whose history was deleted is read from the rollups.
+    """
+    CHUNK = 1000
+
+    @tornado.gen.coroutine
+    def get(self, name):
+        if not self.check_access_right():
+            return
+        date_to = parse_date(self.get_argument("to")) if self.get_argument("to", None) else datetime.utcnow()
+        date_from = parse_date(self.get_argument("from")) if self.get_argument("from", None) \
+            else date_to - timedelta(days=1)
+        bucket = parse_bucket(self.get_argument("bucket", "1h"))
+        mode = self.get_argument("mode", "auto")
+        if mode not in ("auto", "numeric", "changes"):
+            raise tornado.web.HTTPError(400, "Unknown mode: %s", mode)
+
+        db = self.stream_session()
+        if db is None:
+            return
+        try:
+            device_ids = []
+            for ident in self.get_arguments("device"):
+                device_id = db.query(Device.id).filter(Device.ident == ident).scalar()
+                if device_id is None and ident.isdigit():
+                    device_id = int(ident)
+                if device_id is None:
+                    raise tornado.web.HTTPError(404, "Unknown device: %s", ident)
+                device_ids.append(device_id)
+            if not device_ids:
+                raise tornado.web.HTTPError(400, "No device specified")
+
+            # The history before the cutoff has been deleted, only its rollups remain
+            cutoff = history_cutoff()
+            raw_from = max(date_from, cutoff) if cutoff else date_from
+            rollup_to = min(date_to, cutoff) if cutoff and date_from < cutoff else None
+            period = ROLLUP_DAY if bucket % ROLLUP_DAY == 0 else ROLLUP_HOUR
+
+            if mode == "auto":
+                history = history_union(db, raw_from, date_to)
+                first = db.query(history.c.value).filter(
+                    history.c.device_id.in_(device_ids),
+                    history.c.name == name
+                ).limit(1).scalar()
+                if first is None and rollup_to:
+                    first = db.query(DevicePropertyRollup.last_value).filter(
+                        DevicePropertyRollup.device_id.in_(device_ids),
+                        DevicePropertyRollup.name == name,
+                        DevicePropertyRollup.period == period,
+                        DevicePropertyRollup.date >= date_from,
+                        DevicePropertyRollup.date < rollup_to
+                    ).limit(1).scalar()
+                mode = "numeric" if first is not None and is_number(first) else "changes"
+
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+            self.write('{{"name": {name}, "bucket": {bucket}, "mode": "{mode}", "points": ['.format(
+                name=json.dumps(name), bucket=bucket, mode=mode))
+            points = []
+            for device_id in device_ids:
+                if mode == "numeric":
+                    if rollup_to:
+                        points.append(self.rollup_numeric_points(db, device_id, name, period, date_from, rollup_to, bucket))
+                    points.append(self.numeric_points(db, device_id, name, raw_from, date_to, bucket))
+                else:
+                    points.append(self.changes_points(db, device_id, name, date_from, raw_from, rollup_to, date_to))
+            separator = ""
+            for chunk in chunks(itertools.chain(*points), self.CHUNK):
+                self.write(separator + ", ".join(json.dumps(point) for point in chunk))
+                separator = ", "
+                yield self.flush()
+            self.write("]}")
+        finally:
+            self.stream_done(db)
+
+    def numeric_points(self, db, device_id, name, date_from, date_to, bucket):
+        history = history_union(db, date_from, date_to)
+        number = sqlalchemy.cast(history.c.value, sqlalchemy.Float)
+        slot = sqlalchemy.cast(sqlalchemy.func.strftime('%s', history.c.date), Integer) / bucket
+        buckets = sqlalchemy.select([
+            history.c.device_id,
+            history.c.name,
+            slot.label("slot"),
+            sqlalchemy.func.min(number).label("min"),
+            sqlalchemy.func.max(number).label("max"),
+            sqlalchemy.func.avg(number).label("avg"),
+            sqlalchemy.func.count().label("count"),
+            sqlalchemy.func.max(history.c.date).label("last_date")
+        ]).where(sqlalchemy.and_(
+            # A range of the (device_id, name, date) index of each table
+            history.c.device_id == device_id,
+            history.c.name == name,
+            history_is_number(history.c.value)
+        )).group_by(slot).alias("buckets")
+        # The last value of each bucket is found with the unique (device_id, name, date) index
+        last = history_union(db, date_from, date_to)
+        query = sqlalchemy.select([buckets, last.c.value]).select_from(
+            buckets.join(last, sqlalchemy.and_(
+                last.c.device_id == device_id,
+                last.c.name == name,
+                last.c.date == buckets.c.last_date
+            ))
+        ).order_by(buckets.c.slot)
+        for row in db.execute(query):
+            yield {
+                "device_id": device_id,
+                "date": str(datetime.utcfromtimestamp(row.slot * bucket)),
+                "min": row.min,
+                "max": row.max,
+                "avg": row.avg,
+                "count": row.count,
+                "last": json.loads(row.value)
+            }
+
+    def rollup_numeric_points(self, db, device_id, name, period, date_from, date_to, bucket):
+        rollup = DevicePropertyRollup.__table__
+        slot = sqlalchemy.cast(sqlalchemy.func.strftime('%s', rollup.c.date), Integer) / max(bucket, period)
+        buckets = sqlalchemy.select([
+            rollup.c.device_id,
+            rollup.c.name,
+            rollup.c.period,
+            slot.label("slot"),
+            sqlalchemy.func.min(rollup.c.min).label("min"),
+            sqlalchemy.func.max(rollup.c.max).label("max"),
+            (sqlalchemy.func.sum(rollup.c.sum) / sqlalchemy.func.sum(rollup.c.number_count)).label("avg"),
+            sqlalchemy.func.sum(rollup.c.number_count).label("count"),
+            sqlalchemy.func.max(rollup.c.last_date).label("last_date")
+        ]).where(sqlalchemy.and_(
+            rollup.c.device_id == device_id,
+            rollup.c.name == name,
+            rollup.c.period == period,
+            rollup.c.date >= date_from,
+            rollup.c.date < date_to,
+            rollup.c.number_count > 0
+        )).group_by(slot).alias("buckets")
+        last = rollup.alias("last")
+        query = sqlalchemy.select([buckets, last.c.last_value]).select_from(
+            buckets.join(last, sqlalchemy.and_(
+                last.c.device_id == buckets.c.device_id,
+                last.c.name == buckets.c.name,
+                last.c.period == buckets.c.period,
+                last.c.last_date == buckets.c.last_date
+            ))
+        ).order_by(buckets.c.slot)
+        for row in db.execute(query):
+            yield {
+                "device_id": device_id,
+                "date": str(datetime.utcfromtimestamp(row.slot * max(bucket, period))),
+                "min": row.min,
+                "max": row.max,
+                "avg": row.avg,
+                "count": row.count,
+                "last": json.loads(row.last_value)
+            }
+
+    def changes_points(self, db, device_id, name, date_from, raw_from, rollup_to, date_to):
+        rollup = DevicePropertyRollup.__table__
+        previous = None
+        # The value in effect at the beginning of the range
+        if not rollup_to:
+            history = history_union(db, None, date_from)
+            previous = db.execute(
+                sqlalchemy.select([history.c.value]).where(sqlalchemy.and_(
+                    history.c.device_id == device_id,
+                    history.c.name == name,
+                    history.c.date < date_from
+                )).order_by(history.c.date.desc()).limit(1)
+            ).scalar()
+            if previous is not None:
+                yield {"device_id": device_id, "date": str(date_from), "value": json.loads(previous)}
+        else:
+            # Hourly rollups only know the last value of each hour
+            query = sqlalchemy.select([rollup.c.date, rollup.c.last_value.label("value")]).where(sqlalchemy.and_(
+                rollup.c.device_id == device_id,
+                rollup.c.name == name,
+                rollup.c.period == ROLLUP_HOUR,
+                rollup.c.date >= date_from,
+                rollup.c.date < rollup_to
+            )).order_by(rollup.c.date)
+            for row in db.execute(query):
+                if row.value != previous:
+                    previous = row.value
+                    yield {"device_id": device_id, "date": str(row.date), "value": json.loads(row.value)}
+        history = history_union(db, raw_from, date_to)
+        query = sqlalchemy.select([history.c.date, history.c.value]).where(sqlalchemy.and_(
+            history.c.device_id == device_id,
+            history.c.name == name
+        )).order_by(history.c.date)
+        for row in db.execute(query):
+            if row.value != previous:
+                previous = row.value
+                yield {"device_id": device_id, "date": str(row.date), "value": json.loads(row.value)}
+
+
+def history_is_number(value):
+    """SQL condition telling if a stored (JSON) property value is a number."""
+    return sqlalchemy.or_(value.op("GLOB")("[0-9]*"), value.op("GLOB")("-[0-9]*"))
+
+
+ROLLUP_HOUR = 3600
+ROLLUP_DAY = 86400
+
+
+def history_cutoff():
+    """Date before which the properties history is deleted, None if it is kept forever."""
+    days = int(conf_get("history_retention_days", "0") or 0)
+    return datetime.utcnow() - timedelta(days=days) if days > 0 else None
+
+
+class Compaction(object):
+    """Rolls up the properties history by hours and days, and deletes what is past its retention.
+
+    It runs periodically from its own thread, doing steps until its time budget is spent. Each step is a transaction
+    over a batch of devices (compaction_batch_size), so that the writers never wait for long for the write lock.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.started = False
+        # Hour being rolled up and month being dropped, the last device done and the last history ids when they started
+        self.hour = None
+        self.hour_after = 0
+        self.hour_last_ids = None
+        self.month = None
+        self.month_after = 0
+        self.month_last_id = None
+
+    def run(self):
+        deadline = time.time() + self.budget
+        try:
+            if not self.started:
+                self.pending_backfill()
+                self.started = True
+            while time.time() < deadline:
+                if not (self.rollup_hour() or self.drop_history() or self.delete_history() or self.delete_reports()
+                        or self.drop_events()):
+                    break
+        except Exception:
+            session.rollback()
+            app_log.exception("Compaction failed")
+        finally:
+            session.remove()
+
+    def pending_backfill(self):
+        """The history written before the rollups existed has to be rolled up."""
+        if session.query(DevicePropertyRollup.date).first() or session.query(DevicePropertyRollupPending.date).first():
+            return
+        history = DevicePropertyHistory.__table__
+        hour = sqlalchemy.type_coerce(sqlalchemy.func.strftime('%Y-%m-%d %H:00:00.000000', history.c.date), DateTime)
+        # The history is read before taking the write lock, the new reports mark their hours themselves
+        hours = [row[0] for row in session.execute(sqlalchemy.select([hour]).distinct())]
+        begin_write(session)
+        if hours:
+            session.execute(
+                DevicePropertyRollupPending.__table__.insert().prefix_with("OR IGNORE"),
+                [{"date": date} for date in hours]
+            )
+        session.commit()
+
+    def batch(self, after):
+        """Last device id of the batch of devices following a device id, None for the last batch."""
+        return session.query(Device.id).filter(Device.id > after).order_by(Device.id)\
+            .offset(int(conf_get("compaction_batch_size", "1000")) - 1).limit(1).scalar()
+
+    @staticmethod
+    def devices(column, after, upper, written=None):
+        """Devices of a batch, the last one also has the devices whose rows were written since the first one."""
+        devices = column > after if upper is None else sqlalchemy.and_(column > after, column <= upper)
+        if written is not None:
+            devices = sqlalchemy.or_(devices, column.in_(written))
+        return devices
+
+    def rollup_hour(self):
+        """Rolls up a batch of devices of the oldest complete hour whose history changed, and updates the rollup of
+        their day.
+
+        The hour stays pending until its last batch, which also rolls up again the devices whose history of the hour was
+        written since the first one.
+        """
+        start = session.query(DevicePropertyRollupPending.date).filter(
+            DevicePropertyRollupPending.date < datetime.utcnow() - timedelta(hours=1)
+        ).order_by(DevicePropertyRollupPending.date).limit(1).scalar()
+        if not start:
+            return False
+        end = start + timedelta(hours=1)
+        if start != self.hour:
+            self.hour, self.hour_after, self.hour_last_ids = start, 0, None
+        upper = self.batch(self.hour_after)
+
+        begin_write(session)
+        tables = history_tables(session, start, end)
+        if self.hour_last_ids is None:
+            self.hour_last_ids = dict(
+                (table.name, session.query(sqlalchemy.func.max(table.c.id)).scalar() or 0) for table in tables
+            )
+        written = None
+        if upper is None:
+            written = [
+                sqlalchemy.select([table.c.device_id]).where(sqlalchemy.and_(
+                    table.c.id > self.hour_last_ids.get(table.name, 0),
+                    table.c.date >= start,
+                    table.c.date < end
+                )) for table in tables
+            ]
+            written = sqlalchemy.union(*written) if len(written) > 1 else written[0]
+        batch = (self.hour_after, upper, written)
+
+        history = history_union(session, start, end)
+        rollup = DevicePropertyRollup.__table__
+        number = sqlalchemy.case([
+            (history_is_number(history.c.value), sqlalchemy.cast(history.c.value, sqlalchemy.Float))
+        ])
+        session.execute(rollup.insert().prefix_with("OR REPLACE").from_select(
+            ["device_id", "name", "period", "date", "count", "number_count", "min", "max", "sum", "last_date"],
+            sqlalchemy.select([
+                history.c.device_id,
+                history.c.name,
+                sqlalchemy.literal(ROLLUP_HOUR),
+                sqlalchemy.literal(start, DateTime),
+                sqlalchemy.func.count(),
+                sqlalchemy.func.count(number),
+                sqlalchemy.func.min(number),
+                sqlalchemy.func.max(number),
+                sqlalchemy.func.sum(number),
+                sqlalchemy.func.max(history.c.date)
+            ]).where(self.devices(history.c.device_id, *batch)).group_by(history.c.device_id, history.c.name)
+        ))
+        self.update_last_values(ROLLUP_HOUR, start, self.devices(rollup.c.device_id, *batch), [
+            sqlalchemy.select([table.c.value]).where(sqlalchemy.and_(
+                table.c.device_id == rollup.c.device_id,
+                table.c.name == rollup.c.name,
+                table.c.date == rollup.c.last_date
+            )) for table in tables
+        ])
+
+        # The rollup of the day is updated with each of its hours
+        day = start.replace(hour=0)
+        hourly = rollup.alias("hourly")
+        session.execute(rollup.insert().prefix_with("OR REPLACE").from_select(
+            ["device_id", "name", "period", "date", "count", "number_count", "min", "max", "sum", "last_date"],
+            sqlalchemy.select([
+                hourly.c.device_id,
+                hourly.c.name,
+                sqlalchemy.literal(ROLLUP_DAY),
+                sqlalchemy.literal(day, DateTime),
+                sqlalchemy.func.sum(hourly.c.count),
+                sqlalchemy.func.sum(hourly.c.number_count),
+                sqlalchemy.func.min(hourly.c.min),
+                sqlalchemy.func.max(hourly.c.max),
+                sqlalchemy.func.sum(hourly.c.sum),
+                sqlalchemy.func.max(hourly.c.last_date)
+            ]).where(sqlalchemy.and_(
+                hourly.c.period == ROLLUP_HOUR,
+                hourly.c.date >= day,
+                hourly.c.date < end,
+                self.devices(hourly.c.device_id, *batch)
+            )).group_by(hourly.c.device_id, hourly.c.name)
+        ))
+        hourly = rollup.alias("hourly")
+        self.update_last_values(ROLLUP_DAY, day, self.devices(rollup.c.device_id, *batch), [
+            sqlalchemy.select([hourly.c.last_value]).where(sqlalchemy.and_(
+                hourly.c.device_id == rollup.c.device_id,
+                hourly.c.name == rollup.c.name,
+                hourly.c.period == ROLLUP_HOUR,
+                hourly.c.last_date == rollup.c.last_date
+            ))
+        ])
+        if upper is None:
+            session.query(DevicePropertyRollupPending).filter(DevicePropertyRollupPending.date == start)\
+                .delete(synchronize_session=False)
+        session.commit()
+        if upper is None:
+            self.hour = None
+        else:
+            self.hour_after = upper
+        return True
+
+    def update_last_values(self, period, date, devices, selects):
+        """The last value is the first one found by the selects, the tables where it may be."""
+        rollup = DevicePropertyRollup.__table__
+        values = [select.limit(1).as_scalar() for select in selects]
+        session.execute(rollup.update().where(sqlalchemy.and_(
+            rollup.c.period == period,
+            rollup.c.date == date,
+            devices
+        )).values(last_value=sqlalchemy.func.coalesce(*values) if len(values) > 1 else values[0]))
+
+    def drop_history(self):
+        """Drops the oldest month of history past its retention, once it is rolled up.
+
+        The last values of its properties are copied to the device_property_history table first, a batch of devices at
+        a time, they may still be in effect. delete_history then deletes the ones a later month replaced.
+        """
+        cutoff = history_cutoff()
+        if not cutoff:
+            return False
+        pending = session.query(sqlalchemy.func.min(DevicePropertyRollupPending.date)).scalar()
+        if pending:
+            cutoff = min(cutoff, pending)
+        months = history_partitions.before(session, cutoff)
+        if not months:
+            return False
+        if months[0] != self.month:
+            self.month, self.month_after, self.month_last_id = months[0], 0, None
+        upper = self.batch(self.month_after)
+
+        begin_write(session)
+        table = history_partitions.table(self.month)
+        if self.month_last_id is None:
+            self.month_last_id = session.query(sqlalchemy.func.max(table.c.id)).scalar() or 0
+        written = None
+        if upper is None:
+            # Late reports may have written to the month since its first batch
+            written = sqlalchemy.select([table.c.device_id]).where(table.c.id > self.month_last_id)
+        # The values of the rows having the max date of their (device_id, name)
+        session.execute(DevicePropertyHistory.__table__.insert().prefix_with("OR IGNORE").from_select(
+            ["device_id", "report_id", "date", "name", "value"],
+            sqlalchemy.select([
+                table.c.device_id, table.c.report_id, sqlalchemy.func.max(table.c.date), table.c.name, table.c.value
+            ]).where(self.devices(table.c.device_id, self.month_after, upper, written))\
+                .group_by(table.c.device_id, table.c.name)
+        ))
+        if upper is None:
+            history_partitions.drop(session, self.month)
+        session.commit()
+        if upper is None:
+            self.month = None
+        else:
+            self.month_after = upper
+        return True
+
+    def delete_history(self):
+        """Deletes a batch of the device_property_history table past its retention, once it is rolled up.
+
+        The last value of each property before the cutoff is kept, it's still in effect when only the changes are
+        stored.
+        """
+        cutoff = history_cutoff()
+        if not cutoff:
+            return False
+        pending = session.query(sqlalchemy.func.min(DevicePropertyRollupPending.date)).scalar()
+        if pending:
+            cutoff = min(cutoff, pending)
+        newer = aliased(DevicePropertyHistory)
+        ids = [row.id for row in session.query(DevicePropertyHistory.id).filter(
+            DevicePropertyHistory.date < cutoff,
+            session.query(newer.id).filter(
+                newer.device_id == DevicePropertyHistory.device_id,
+                newer.name == DevicePropertyHistory.name,
+                newer.date > DevicePropertyHistory.date,
+                newer.date < cutoff
+            ).exists()
+        ).limit(int(conf_get("compaction_batch_size", "1000")))]
+        if not ids:
+            return False
+        begin_write(session)
+        for chunk in chunks(ids):
+            session.query(DevicePropertyHistory).filter(DevicePropertyHistory.id.in_(chunk))\
+                .delete(synchronize_session=False)
+        session.commit()
+        return True
+
+    def drop_events(self):
+        """Drops the months of events past their retention."""
+        days = int(conf_get("event_retention_days", "0") or 0)
+        if days <= 0:
+            return False
+        begin_write(session)
+        dropped = event_partitions.drop_before(session, datetime.utcnow() - timedelta(days=days))
+        session.commit()
+        return dropped > 0
+
+    def delete_reports(self):
+        """Deletes a batch of reports past their retention.
+
+        Their properties history may still be in effect or kept longer, its report_id is cleared. The rows of a report
+        have its date, so they are found by the date index of the tables of these dates.
+        """
+        days = int(conf_get("report_retention_days", "0") or 0)
+        if days <= 0:
+            return False
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        reports = session.query(DeviceReport.id, DeviceReport.date).filter(DeviceReport.date < cutoff)\
+            .limit(int(conf_get("compaction_batch_size", "1000"))).all()
+        if not reports:
+            return False
+        ids = [report.id for report in reports]
+        date_from = min(report.date for report in reports)
+        date_to = max(report.date for report in reports) + timedelta(microseconds=1)
+        begin_write(session)
+        for chunk in chunks(ids):
+            for table in history_tables(session, date_from, date_to):
+                session.execute(table.update().where(sqlalchemy.and_(
+                    table.c.date >= date_from,
+                    table.c.date < date_to,
+                    table.c.report_id.in_(chunk)
+                )).values(report_id=None))
+            session.query(DeviceReport).filter(DeviceReport.id.in_(chunk)).delete(synchronize_session=False)
+        session.commit()
+        return True
+
+
 class GroupsPage(SecureHandler):
     def get(self):
-        self.check_access_right()
+        if not self.check_access_right():
+            return
         action = self.get_argument("action", None)
 
         group = None
@@ -525,40 +3540,112 @@ class GroupsPage(SecureHandler):
             if not self.check_admin_right():
                 return
             name = self.get_argument("name", "")
+            try:
+                parent_id = int(self.get_argument("parent_id", "") or 0) or None
+                group_id = int(self.get_argument("group_id", "") or 0) if action == 'mod' else None
+            except ValueError:
+                raise tornado.web.HTTPError(400, "Incorrect group id")
+            if name:
+                # The group and the hierarchy are changed in the same transaction, nobody can change them meanwhile
+                begin_write(session)
             if action == 'add':
                 group = DeviceGroup()
                 group.name = ""
                 group.ident = ""
             else:
-                group = session.query(DeviceGroup).filter(DeviceGroup.id==int(self.get_argument("group_id"))).first()
+                group = session.query(DeviceGroup).filter(DeviceGroup.id == group_id).first()
+                if not group:
+                    raise tornado.web.HTTPError(404, "Unknown group: %s", group_id)
             if name:
                 group.name = name
-                group.parent_id = self.get_argument("parent_id", "")
+                group.parent_id = parent_id
                 group.ident = re.sub(r'\W+', '', self.get_argument("ident", ""))
-                if group.parent:
-                    group.depth = group.parent.depth + 1
-                else:
-                    group.depth = 0
 
-                try:
-                    session.merge(group)
-                    session.commit()
-                except IntegrityError as e:
-                    error = str(e)
+                with session.no_autoflush:
+                    cycle = group.id and group.parent_id and session.query(DeviceGroupTree).filter(
+                        DeviceGroupTree.ancestor_id == group.id,
+                        DeviceGroupTree.descendant_id == group.parent_id).first()
+                if cycle:
+                    error = _("A group can't be moved under one of its subgroups")
                     session.rollback()
-                group = None
+                else:
+                    try:
+                        session.merge(group)
+                        session.flush()
+                        group_tree_rebuild(session)
+                        session.commit()
+                    except IntegrityError as e:
+                        error = str(e)
+                        session.rollback()
+                    group = None
 
         groups = session.query(DeviceGroup).order_by(DeviceGroup.depth.desc(), DeviceGroup.name).all()
+        subtrees = group_subtree_stats()
 
-        self.render("groups.html", title=_("Groups"), groups=groups, current_group=group, error=error)
+        self.render(
+            "groups.html", title=_("Groups"), groups=groups, subtrees=subtrees, current_group=group, error=error
+        )
 
     def post(self):
         self.get()
 
 
+def group_subtree_stats(group_id=None):
+    """Stats of the groups including their subgroups, by group id."""
+    tree = DeviceGroupTree
+    query = session.query(
+        tree.ancestor_id,
+        sqlalchemy.func.sum(DeviceGroupStats.device_count),
+        sqlalchemy.func.sum(DeviceGroupStats.seen_24h),
+        sqlalchemy.func.max(DeviceGroupStats.last_report_date)
+    ).join(DeviceGroupStats, DeviceGroupStats.group_id == tree.descendant_id).group_by(tree.ancestor_id)
+    if group_id is not None:
+        query = query.filter(tree.ancestor_id == group_id)
+    return dict((row[0], row[1:]) for row in query)
+
+
+def group_stats_dict(stats):
+    device_count, seen_24h, last_report_date = stats or (0, 0, None)
+    return {
+        "device_count": device_count or 0,
+        "seen_24h": seen_24h or 0,
+        "last_report_date": str(last_report_date) if last_report_date else None
+    }
+
+
+class GroupsApi(SecureHandler):
+    """Groups with their stats, and those of their subtree."""
+    def get(self, group_id=None):
+        if not self.check_access_right():
+            return
+        query = session.query(DeviceGroup, DeviceGroupStats).outerjoin(
+            DeviceGroupStats, DeviceGroupStats.group_id == DeviceGroup.id
+        ).order_by(DeviceGroup.id)
+        if group_id is not None:
+            group_id = int(group_id)
+            query = query.filter(DeviceGroup.id.in_(group_subtree(group_id)))
+        subtrees = group_subtree_stats()
+        self.write({
+            "groups": [
+                {
+                    "id": group.id,
+                    "name": group.name,
+                    "ident": group.ident,
+                    "parent_id": group.parent_id or None,
+                    "depth": group.depth,
+                    "stats": group_stats_dict(
+                        (stats.device_count, stats.seen_24h, stats.last_report_date) if stats else None
+                    ),
+                    "subtree": group_stats_dict(subtrees.get(group.id))
+                } for group, stats in query
+            ]
+        })
+
+
 class UsersPage(SecureHandler):
     def get(self):
-        self.check_access_right()
+        if not self.check_access_right():
+            return
         action = self.get_argument("action", None)
 
         user = None
@@ -580,10 +3667,11 @@ class UsersPage(SecureHandler):
                 user.right = right
                 if password or user.password:
                     if password:
-                        user.password = hashlib.sha1(password).hexdigest()
+                        user.password = password_hash(password)
                     try:
-                        session.merge(user)
+                        user = session.merge(user)
                         session.commit()
+                        user_cache.invalidate(user.id)
                         user = None
                     except IntegrityError as e:
                         error = str(e)
@@ -599,7 +3687,7 @@ class UsersPage(SecureHandler):
         self.get()
 
 
-class Login(tornado.web.RequestHandler):
+class Login(SessionHandler):
     def get(self):
         error = None
         if bool(self.get_argument("logout", "false")):
@@ -613,35 +3701,103 @@ class Login(tornado.web.RequestHandler):
 
     def post(self):
         error = None
-        user = session.query(User).filter(
-            User.name == self.get_argument("username", ""),
-            User.password == hashlib.sha1(self.get_argument("password", "")).hexdigest()
-        ).first()
+        password = self.get_argument("password", "")
+        user = session.query(User).filter(User.name == self.get_argument("username", "")).first()
+        if user and not password_check(user.password, password):
+            user = None
         if user:
+            if not user.password.startswith("pbkdf2_sha256$"):
+                # Hashes of older versions are replaced as soon as we know the password
+                user.password = password_hash(password)
+                session.commit()
             self.set_secure_cookie("user_id", str(user.id))
         else:
             error = "Could not authenticate you"
         self.render('auth.html', title=_("Authentication"), user=user, error=error)
 
 
+class MetricsPage(tornado.web.RequestHandler):
+    """Metrics of this process, in the Prometheus text format."""
+    def get(self):
+        gauges = {"edms_db_size_bytes": sum(
+            os.path.getsize(path) for path in (args.db, args.db + "-wal") if os.path.exists(path)
+        )}
+        if report_writer:
+            gauges["edms_ingest_queue_size"] = report_writer.queue.qsize()
+        if event_writer:
+            gauges["edms_event_queue_size"] = event_writer.queue.qsize()
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(metrics.render(gauges))
+
+
+class ProfilePage(SecureHandler):
+    """Slowest of the profiled requests."""
+    def get(self):
+        if not self.check_admin_right():
+            return
+        self.render(
+            "profile.html",
+            title=_("Slowest requests"),
+            sample=args.profile_sample,
+            profiles=profiler.profiles()
+        )
+
+
+def log_request(handler):
+    """Records the metrics of a request, and logs it as tornado does."""
+    name = type(handler).__name__
+    duration = handler.request.request_time()
+    metrics.inc("edms_requests_total", handler=name, method=handler.request.method, status=handler.get_status())
+    metrics.observe("edms_request_duration_seconds", duration, handler=name)
+    metrics.sql_done(handler=name)
+    profiler.done(handler)
+
+    if handler.get_status() < 400:
+        log_method = access_log.info
+    elif handler.get_status() < 500:
+        log_method = access_log.warning
+    else:
+        log_method = access_log.error
+    log_method("%d %s %.2fms", handler.get_status(), handler._request_summary(), 1000.0 * duration)
+
+
 application = tornado.web.Application(
     # Paths
     [
+        (r"/device/event", DeviceEventPage),
         (r"/device/(.+)", DeviceById),
         (r"/devices", Devices),
+        (r"/api/devices", DevicesApi),
+        (r"/api/events", DeviceEventsApi),
+        (r"/api/devices/search", DevicesSearchApi),
+        (r"/api/device/([0-9]+)/reports", DeviceReportsApi),
+        (r"/api/property/([^/]+)/series", PropertySeriesApi),
         (r"/", Index),
         (r"/about", About),
         (r"/report", DeviceReportPage),
+        (r"/device-config", DeviceConfigPoll),
+        (r"/device-config/ack", DeviceConfigAck),
+        (r"/api/device/([0-9]+)/config", DeviceConfigApi),
+        (r"/reports/bulk", DeviceReportsBulkPage),
         (r"/report/([0-9]+)", ShowReport),
         (r"/last-reports", LastReports),
+        (r"/last-reports/feed", ReportFeedHandler),
+        (r"/export/reports", ExportReports),
+        (r"/export/properties", ExportProperties),
         (r"/config", ConfigPage),
         (r"/config/(.+)", ConfigPage),
         (r"/groups", GroupsPage),
+        (r"/api/groups", GroupsApi),
+        (r"/api/group/([0-9]+)/subtree", GroupsApi),
         (r"/users", UsersPage),
-        (r"/login", Login)
+        (r"/login", Login),
+        (r"/metrics", MetricsPage),
+        (r"/profile", ProfilePage)
     ],
     # Config
-    debug=True,
+    # The autoreload of the debug mode can't be used with many processes
+    debug=args.processes == 1,
+    log_function=log_request,
     cookie_secret=conf_get('.cookie_secret', base64.b64encode(uuid.uuid4().bytes + uuid.uuid4().bytes)),
     static_path=os.path.join(os.path.dirname(__file__), "static"),
     template_path=os.path.join(os.path.dirname(__file__), "templates")
@@ -654,6 +3810,11 @@ def launch_setup():
     conf_get("report_possible_device_group_field", "device_group")
     conf_get("report_json_flatten", "true")
     conf_get("device_group_auto_create", "false")
+    conf_get("report_history_changes_only", "false")
+    conf_get("history_retention_days", "0")
+    conf_get("report_retention_days", "0")
+    conf_get("event_retention_days", "0")
+    conf_get("compaction_batch_size", "1000")
 
     # We update the number of launches
     nbLaunches = conf_get("nb_launches")
@@ -666,14 +3827,197 @@ def launch_setup():
     # We check if we have a user "admin" and if not we create it:
     user = session.query(User).filter(User.name == "admin").first()
     if not user:
-        user = User(name="admin", password=hashlib.sha1("admin").hexdigest(), right=User.RIGHT_ADMIN)
+        user = User(name="admin", password=password_hash("admin"), right=User.RIGHT_ADMIN)
         session.add(user)
         session.commit()
         print("Created user \"admin\" with pass \"admin\".")
 
+# Search indexes that aren't used to store reports, an import can build them once it's done
+DEFERRABLE_INDEXES = (
+    "device_date_seen_id",
+    "device_group_id",
+    "device_report_device_id_date_id",
+    "device_properties_name_value",
+    "device_properties_name_value_device",
+    "device_property_history_name_value_report",
+    "device_property_history_date",
+)
+
+
+def import_parse(lines):
+    """Parses some NDJSON lines in a parser process, there's one result (report or error message) per line."""
+    parsed = []
+    for line in lines:
+        if not line.strip():
+            parsed.append(None)
+            continue
+        try:
+            parsed.append(report_parse(json.loads(line)))
+        except ValueError:
+            parsed.append("Invalid JSON")
+        except ReportError as e:
+            parsed.append(e.message)
+        except Exception as e:
+            # A bad line is one error, it must not stop the import
+            parsed.append("Invalid report: {error!r}".format(error=e))
+    return parsed
+
+
+def import_worker_init():
+    """Only the importing process handles Ctrl-C, it then lets the parser processes finish their lines."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class ReportImport(object):
+    """Imports NDJSON report files, as sent to /report, in large transactions.
+
+    Lines are parsed by a pool of processes and stored by this one. The number of lines stored for each file is saved
+    in a checkpoint file after each transaction, so that an interrupted import can be resumed.
+    """
+    def __init__(self, batch_size, workers, checkpoint_path, defer_indexes):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint_path = checkpoint_path
+        self.defer_indexes = defer_indexes
+        self.checkpoint = {}
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                self.checkpoint = json.load(f)
+        self.started = self.progress = time.time()
+        self.nb_lines = self.nb_reports = self.nb_errors = 0
+        self.batch = []
+        self.batch_lines = 0
+        self.stopping = False
+
+    def run(self, files):
+        if self.defer_indexes:
+            for index in DEFERRABLE_INDEXES:
+                session.execute("DROP INDEX IF EXISTS {name}".format(name=index))
+            history_partitions.defer_indexes(session)
+            session.commit()
+
+        # The parser processes use the config that is already loaded, not the connections
+        conf_get("report_possible_ident_fields")
+        session.remove()
+        engine.dispose()
+        pool = multiprocessing.Pool(self.workers, import_worker_init) if self.workers > 1 else None
+        try:
+            for path in files:
+                self.import_file(pool, path)
+        finally:
+            self.stop(pool)
+            if self.defer_indexes:
+                db_create()
+                history_partitions.undefer_indexes(session)
+                session.commit()
+
+        print("Imported {reports} reports from {lines} lines in {time:.0f}s, {errors} errors".format(
+            reports=self.nb_reports, lines=self.nb_lines, time=time.time() - self.started, errors=self.nb_errors))
+
+    def import_file(self, pool, path):
+        state = self.checkpoint.setdefault(path, {"lines": 0, "done": False})
+        if state["done"]:
+            print("{path}: already imported".format(path=path))
+            return
+        with (gzip.open(path) if path.endswith(".gz") else open(path)) as f:
+            lines = chunks(itertools.takewhile(
+                lambda line: not self.stopping, itertools.islice(f, state["lines"], None)), 1000)
+            try:
+                for parsed_lines in pool.imap(import_parse, lines) if pool else itertools.imap(import_parse, lines):
+                    for i, parsed in enumerate(parsed_lines):
+                        if isinstance(parsed, dict):
+                            self.batch.append(parsed)
+                        elif parsed:
+                            self.nb_errors += 1
+                            if self.nb_errors <= 10:
+                                print("{path}:{line}: {error}".format(
+                                    path=path, line=state["lines"] + self.batch_lines + i + 1, error=parsed))
+                    self.batch_lines += len(parsed_lines)
+                    if len(self.batch) >= self.batch_size:
+                        self.commit(state)
+                    if time.time() - self.progress > 5:
+                        self.print_progress(path, state)
+            except BaseException:
+                # The pool reads the file from its own thread, it must be stopped before the file is closed
+                self.stop(pool)
+                raise
+        state["done"] = True
+        self.commit(state)
+        self.print_progress(path, state)
+
+    def stop(self, pool):
+        """Stops reading lines and waits for the parser processes to finish the ones they have.
+
+        Pool.terminate() isn't used: it can deadlock when a parser is sending back a large result.
+        """
+        self.stopping = True
+        if pool:
+            pool.close()
+            pool.join()
+
+    def commit(self, state):
+        if self.batch:
+            store_reports(self.batch)
+            session.remove()
+        self.nb_reports += len(self.batch)
+        self.nb_lines += self.batch_lines
+        state["lines"] += self.batch_lines
+        self.batch = []
+        self.batch_lines = 0
+        with open(self.checkpoint_path + ".tmp", "w") as f:
+            json.dump(self.checkpoint, f)
+        os.rename(self.checkpoint_path + ".tmp", self.checkpoint_path)
+
+    def print_progress(self, path, state):
+        self.progress = time.time()
+        sys.stderr.write("{path}: {lines} lines, {reports} reports, {errors} errors, {rate:.0f} reports/s\n".format(
+            path=path,
+            lines=state["lines"] + self.batch_lines,
+            reports=self.nb_reports,
+            errors=self.nb_errors,
+            rate=self.nb_reports / max(self.progress - self.started, 0.001)
+        ))
+
+
 if __name__ == "__main__":
-    application.listen(args.port)
     launch_setup()
+    device_idents.preload(session, Device.date_seen.desc())
+    group_backfill()
+    session.remove()
+    if args.command == "import":
+        ReportImport(
+            args.import_batch_size,
+            args.import_workers,
+            args.import_checkpoint or args.db + ".import",
+            args.import_defer_indexes
+        ).run(args.files)
+        sys.exit(0)
+    sockets = tornado.netutil.bind_sockets(args.port)
+    if args.processes != 1:
+        # Children must not share the connections of the parent
+        session.remove()
+        engine.dispose()
+        tornado.process.fork_processes(args.processes)
+        # Other processes write the same devices
+        properties_cache.size = 0
+        tornado.ioloop.PeriodicCallback(conf_refresh, args.config_refresh).start()
+        tornado.ioloop.PeriodicCallback(device_config_waiters.check, args.config_refresh).start()
+    server = tornado.httpserver.HTTPServer(application)
+    server.add_sockets(sockets)
+    if args.compaction_period and tornado.process.task_id() in (None, 0):
+        PeriodicThread("compaction", Compaction(args.compaction_budget / 1000.0).run, args.compaction_period).start()
+    if args.group_stats_period and tornado.process.task_id() in (None, 0):
+        PeriodicThread("group-stats", group_stats_refresh, args.group_stats_period).start()
+    tornado.ioloop.PeriodicCallback(report_feed.keepalive, 30000).start()
+    if args.ingest_queue:
+        report_writer = BatchWriter(
+            "report-writer", store_reports, args.ingest_batch_size, args.ingest_linger / 1000.0, args.ingest_high_water
+        )
+        report_writer.start()
+    event_writer = BatchWriter(
+        "event-writer", store_events, args.event_batch_size, args.ingest_linger / 1000.0, args.event_high_water
+    )
+    event_writer.start()
     print("Listening on {port}".format(port=args.port))
     tornado.ioloop.IOLoop.instance().start()
 
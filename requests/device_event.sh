@@ -4,21 +4,34 @@
 # we need to save for future diagnostics
 
 # The easiest way to handle even is simply to save them as JSON file and to send them with a JSON request
+# On metered links, they can be gzipped: device_event.sh gzip
 
-curl http://localhost:8888/device/event -X POST -d '
+MODE=$1
+
+send() {
+  if [ "$MODE" = "gzip" ]; then
+    gzip -9 | curl http://localhost:8888/device/event -H "Content-Encoding: gzip" --data-binary @-
+  else
+    curl http://localhost:8888/device/event --data-binary @-
+  fi
+}
+
+send <<'EOF'
 {
   "ident":"imei:357973040149194",
   "event_type":"battery-low", 
   "date":"2013-11-26 02:38:11",
   "battery-level":"30%"
-}'
+}
+EOF
 
-curl http://localhost:8888/device/event -X POST -d '
+send <<'EOF'
 {
   "ident":"imei:357973040149194",
   "event_type":"high-speed", 
   "date":"2013-11-26 02:40:22",
   "speed":"400kmh"
-}'
+}
+EOF
 
 
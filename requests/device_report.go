@@ -2,6 +2,7 @@ package main
 
 import (
 	"bytes"
+	"compress/gzip"
 	"encoding/json"
 	"fmt"
 	"net/http"
@@ -28,7 +29,23 @@ func main() {
 	}
 
 	b, _ := json.Marshal(rep1)
-	_, err := http.Post("http://localhost:8888/report", "application/json", bytes.NewBuffer(b))
+	body := bytes.NewBuffer(b)
+
+	// go run device_report.go gzip
+	gzipped := len(os.Args) > 1 && os.Args[1] == "gzip"
+	if gzipped {
+		body = new(bytes.Buffer)
+		w := gzip.NewWriter(body)
+		w.Write(b)
+		w.Close()
+	}
+
+	req, _ := http.NewRequest("POST", "http://localhost:8888/report", body)
+	req.Header.Set("Content-Type", "application/json")
+	if gzipped {
+		req.Header.Set("Content-Encoding", "gzip")
+	}
+	_, err := http.DefaultClient.Do(req)
 
 	if err != nil {
 		fmt.Println("Could not send request:", err)
@@ -1,5 +1,6 @@
 #!/usr/bin/python
-import json, urllib2, datetime, os, socket
+# usage: device_report.py [json|gzip|deflate|msgpack]
+import json, urllib2, datetime, os, socket, sys, zlib
 
 report = {
     "hostname": socket.gethostname(),
@@ -13,4 +14,21 @@ report = {
     }
 }
 
-urllib2.urlopen('http://localhost:8888/report', json.dumps(report))
+mode = sys.argv[1] if len(sys.argv) > 1 else "json"
+headers = {"Content-Type": "application/json"}
+if mode == "msgpack":
+    import msgpack
+    body = msgpack.packb(report)
+    headers["Content-Type"] = "application/msgpack"
+else:
+    body = json.dumps(report)
+if mode == "gzip":
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    body = compressor.compress(body) + compressor.flush()
+    headers["Content-Encoding"] = "gzip"
+elif mode == "deflate":
+    body = zlib.compress(body, 9)
+    headers["Content-Encoding"] = "deflate"
+
+print "{mode}: {size} bytes".format(mode=mode, size=len(body))
+urllib2.urlopen(urllib2.Request('http://localhost:8888/report', body, headers))
@@ -1,8 +1,15 @@
 #!/bin/sh
-curl http://localhost:8888/report -d "{
+# usage: device_report.sh [gzip]
+REPORT="{
   \"hostname\":\"`hostname`\",
   \"date\":\"`date +%Y-%m-%d\ %H:%M:%S.%6N`\",
   \"type\":\"hello_from_shell\",
   \"loadavg\":\"`cat /proc/loadavg`\",
   \"uname\":\"`uname -omr`\"
 }"
+
+if [ "$1" = "gzip" ]; then
+  echo "$REPORT" | gzip -9 | curl http://localhost:8888/report -H "Content-Encoding: gzip" --data-binary @-
+else
+  curl http://localhost:8888/report -d "$REPORT"
+fi